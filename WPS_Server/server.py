@@ -1,45 +1,108 @@
 import base64
+import binascii
+import json
+import math
 import os
+import queue
+import shutil
+import signal
+import socket
 import subprocess
 import tempfile
 import threading
 import time
+import zipfile
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Union
 
 import uvicorn
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from pydantic import BaseModel, ValidationError
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from pywpsrpc.common import S_OK
 from pywpsrpc.rpcetapi import createEtRpcInstance, etapi
 from pywpsrpc.rpcwppapi import createWppRpcInstance, wppapi
 from pywpsrpc.rpcwpsapi import createWpsRpcInstance, wpsapi
 
+from docconv_common import (SPOOL_CHUNK_SIZE, MemoryBudget, Quarantine, TraceMiddleware, annotate, current_trace,
+                            decode_json_file_field, file_digest, stage_timer)
+
 
 # ------------------------------------------------------------------------------
 # 定义全局的 Xvfb 管理器
 # ------------------------------------------------------------------------------
 class XvfbManager:
     def __init__(self, display=":99", screen="0", resolution="800x600x16",
-                 auth="/tmp/xvfb-run.iNFExt/Xauthority", idle_timeout=10):
+                 auth="/tmp/xvfb-run.iNFExt/Xauthority", idle_timeout=10, max_idle_timeout=600,
+                 start_timeout=10, rate_window=600):
         """
         :param display: 虚拟桌面号，如 :99
         :param screen: 屏幕号，通常为 "0"
         :param resolution: 分辨率与色深，示例 "800x600x16" 可降低资源占用
         :param auth: Xvfb 启动时使用的认证文件路径
-        :param idle_timeout: 空闲多长时间（秒）后自动关闭 Xvfb
+        :param idle_timeout: 空闲多长时间（秒）后自动关闭 Xvfb（最短值）
+        :param max_idle_timeout: 按请求到达率延长后的最长空闲时间（秒）
+        :param start_timeout: 等待 Xvfb 就绪的最长时间（秒）
+        :param rate_window: 统计请求间隔的时间窗口（秒）
         """
         self.display = display
         self.screen = screen
         self.resolution = resolution
         self.auth = auth
         self.idle_timeout = idle_timeout
+        self.max_idle_timeout = max_idle_timeout
+        self.start_timeout = start_timeout
+        self.rate_window = rate_window
+        self.current_timeout = idle_timeout
+        # (到达时间, 到达前的空闲时长)
+        self.arrivals = deque()
+        # 预热后、积累到足以估算空闲超时的请求之前，保持 max_idle_timeout，避免预热结果在最短超时后被丢弃
+        self.hold_warm = False
         self.process = None
         self.last_used = None
         self.lock = threading.Lock()
         self.shutdown_timer = None
+        # 关闭 Xvfb 前依次调用的回调
+        self.on_shutdown = []
+
+    @property
+    def socket_path(self):
+        return f"/tmp/.X11-unix/X{self.display.lstrip(':').split('.')[0]}"
+
+    def wait_ready(self):
+        """等待 Xvfb 在 X socket 上开始监听"""
+        deadline = time.monotonic() + self.start_timeout
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Xvfb {self.display} exited with code {self.process.returncode}")
+            try:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(self.socket_path)
+                return
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                self.process.kill()
+                self.process.wait()
+                raise RuntimeError(f"Xvfb {self.display} not ready after {self.start_timeout:g}s")
+            time.sleep(0.01)
 
-    def start_if_not_running(self):
-        """如果 Xvfb 尚未启动，则启动；否则更新最后使用时间，并取消待关闭计时器。"""
+    def start_if_not_running(self, arrival=True):
+        """
+        如果 Xvfb 尚未启动，则启动并等待其就绪；否则更新最后使用时间，并取消待关闭计时器。
+        arrival 表示由转换请求触发（计入空闲间隔统计），预热时为 False。
+        """
         with self.lock:
+            if arrival and self.last_used is not None:
+                now = time.time()
+                self.arrivals.append((now, now - self.last_used))
+            if not arrival:
+                self.hold_warm = True
             if self.process is None:
                 cmd = [
                     "Xvfb", self.display,
@@ -47,35 +110,57 @@ class XvfbManager:
                     "-nolisten", "tcp",
                     "-auth", self.auth
                 ]
-                self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                # 等待 Xvfb 启动
-                time.sleep(1)
-                os.environ["DISPLAY"] = self.display
+                with stage("xvfb_start"):
+                    self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    try:
+                        self.wait_ready()
+                    except Exception:
+                        self.process = None
+                        raise
+                XVFB_RUNNING.inc()
             self.last_used = time.time()
             if self.shutdown_timer is not None:
                 self.shutdown_timer.cancel()
                 self.shutdown_timer = None
 
+    def adaptive_timeout(self):
+        """
+        按最近请求到达前的空闲时长计算空闲超时：取其 90 分位数，使约 90% 的请求到达时 Xvfb 仍是热的；
+        突发流量中批次之间的间隔也会被计入。结果限制在 [idle_timeout, max_idle_timeout]。
+        预热后尚无足够的请求可供估算时取 max_idle_timeout。
+        """
+        now = time.time()
+        while self.arrivals and now - self.arrivals[0][0] > self.rate_window:
+            self.arrivals.popleft()
+        if len(self.arrivals) < 3:
+            return self.max_idle_timeout if self.hold_warm else self.idle_timeout
+        self.hold_warm = False
+        gaps = sorted(gap for _, gap in self.arrivals)
+        p90 = gaps[math.ceil(len(gaps) * 0.9) - 1]
+        return min(max(p90 * 1.1, self.idle_timeout), self.max_idle_timeout)
+
     def schedule_shutdown(self):
-        """调度一个计时器，在空闲 idle_timeout 秒后关闭 Xvfb。"""
+        """调度一个计时器，空闲超过自适应的超时时间后关闭 Xvfb。"""
         with self.lock:
             if self.shutdown_timer is not None:
                 self.shutdown_timer.cancel()
-            self.shutdown_timer = threading.Timer(self.idle_timeout, self.shutdown_if_idle)
+            self.current_timeout = self.adaptive_timeout()
+            self.shutdown_timer = threading.Timer(self.current_timeout, self.shutdown_if_idle)
+            self.shutdown_timer.daemon = True
             self.shutdown_timer.start()
 
     def shutdown_if_idle(self):
-        """如果距离上次使用超过 idle_timeout，则关闭 Xvfb。"""
+        """如果距离上次使用超过当前的空闲超时，则关闭 Xvfb。"""
         with self.lock:
             now = time.time()
-            if self.last_used is None or now - self.last_used >= self.idle_timeout:
+            if self.last_used is None or now - self.last_used >= self.current_timeout:
                 if self.process is not None:
+                    for callback in self.on_shutdown:
+                        callback()
                     self.process.terminate()
                     self.process.wait()
                     self.process = None
-
-# 实例化全局的 Xvfb 管理器
-xvfb_manager = XvfbManager()
+                    XVFB_RUNNING.dec()
 
 # ------------------------------------------------------------------------------
 # 定义支持的文件格式映射
@@ -99,14 +184,17 @@ formats = {
     "csv": etapi.xlCSV,
     "et": '',
 }
-pid = None
+# 只保存部分内容的格式（csv 只含当前工作表），同一文档保存为多个格式时放在最后，
+# 避免另存后影响内存中的文档
+LOSSY_FORMATS = {"csv"}
+
 # ------------------------------------------------------------------------------
 # 定义请求体
 # ------------------------------------------------------------------------------
 class ConvertRequest(BaseModel):
     fileBytes: str  # Base64 编码的文件内容
     sourceType: str  # 源文件类型（如 docx, pdf）
-    targetType: str  # 目标文件类型（如 doc, pdf）
+    targetType: Union[str, List[str]]  # 目标文件类型（如 doc, pdf），多个目标格式时为列表或逗号分隔
 
 # ------------------------------------------------------------------------------
 # 启动 FastAPI 应用
@@ -121,130 +209,739 @@ class ConvertException(Exception):
     def __str__(self):
         return f"Convert failed: {self.text}, ErrCode: {hex(self.hr & 0xFFFFFFFF)}"
 
-# 使用全局锁，确保同一时间只有一个 WPS（或相关）实例在工作
-conversion_lock = threading.Lock()
+class DeadlineExceeded(Exception):
+    """转换超过截止时间，WPS 进程已被强制结束"""
+
+class Quarantined(Exception):
+    """输入文件曾导致转换超时，已被隔离"""
+
+# ------------------------------------------------------------------------------
+# Prometheus 指标（GET /metrics）
+# ------------------------------------------------------------------------------
+STAGE_SECONDS = Histogram(
+    "wps_stage_seconds", "各处理阶段耗时", ["stage"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+CONVERSIONS = Counter("wps_conversions_total", "转换次数（按源格式、目标格式、结果）",
+                      ["source", "target", "result"])
+WORKER_QUEUE = Gauge("wps_worker_queue_depth", "等待空闲 worker 的转换数")
+WORKERS_BUSY = Gauge("wps_workers_busy", "正在转换的 worker 数")
+XVFB_RUNNING = Gauge("wps_xvfb_running", "正在运行的 Xvfb 数")
+OFFICE_RESTARTS = Counter("wps_office_restarts_total", "WPS 实例回收次数", ["kind", "reason"])
+MEMORY_RESERVED = Gauge("wps_memory_reserved_bytes", "整块读入内存处理的请求体占用的内存预算")
+SPOOLED_BODIES = Counter("wps_spooled_bodies_total", "落盘后分块解码的 JSON 请求体数")
+LARGE_LANE_QUEUE = Gauge("wps_large_lane_queue_depth", "等待大文件通道的转换数")
+
+# ------------------------------------------------------------------------------
+# 请求追踪（见 docconv_common，与网关共用）：沿用网关转发的 X-Request-ID，
+# 响应的 Server-Timing 由网关并入自己的 Server-Timing
+# ------------------------------------------------------------------------------
+_, stage = stage_timer(STAGE_SECONDS)
+# 不输出耗时日志的路径（网关的就绪探测与监控轮询）
+app.add_middleware(TraceMiddleware, skip_paths={"/ready", "/metrics"})
+
+# ------------------------------------------------------------------------------
+# WPS 应用实例池：预先启动文字/演示/表格实例，按次借出、用完归还
+# ------------------------------------------------------------------------------
+# 单个实例转换多少份文档后回收重建
+POOL_MAX_DOCS = int(os.environ.get("WPS_POOL_MAX_DOCS", "50"))
+# 健康检查间隔（秒）
+POOL_HEALTH_INTERVAL = float(os.environ.get("WPS_POOL_HEALTH_INTERVAL", "15"))
+# 服务启动时预热的实例类型，逗号分隔，留空则不预热
+POOL_PREWARM = [k for k in os.environ.get("WPS_POOL_PREWARM", "wps,wpp,et").split(",") if k]
+
+# 实例类型 => (创建函数, 获取应用的方法名, 文档集合属性名, 日志名称)
+APP_KINDS = {
+    "wps": (createWpsRpcInstance, "getWpsApplication", "Documents", "Word"),
+    "wpp": (createWppRpcInstance, "getWppApplication", "Presentations", "PowerPoint"),
+    "et": (createEtRpcInstance, "getEtApplication", "Workbooks", "Excel"),
+}
+
+# 源文件扩展名 => 实例类型
+SOURCE_KINDS = {
+    **dict.fromkeys(['doc', 'docx', 'rtf', 'html', 'pdf', 'xml', 'wps'], "wps"),
+    **dict.fromkeys(['ppt', 'pptx', 'dps'], "wpp"),
+    **dict.fromkeys(['xls', 'xlsx', 'csv', 'et'], "et"),
+}
+
+# WPS 进程从当前进程的环境变量继承 DISPLAY/HOME，启动实例时需串行修改环境变量
+spawn_lock = threading.Lock()
+
+
+def pid_alive(pid):
+    """进程存在且不是僵尸进程"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            state = f.read().rsplit(")", 1)[-1].split()[0]
+    except (OSError, IndexError):
+        return False
+    return state not in ("Z", "X")
+
+
+def kill_pid(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+class OfficeInstance:
+    """池中的一个 WPS 应用实例，持有 rpc 对象、应用对象和进程 PID。"""
+
+    def __init__(self, kind, environ):
+        self.kind = kind
+        self.environ = environ
+        self.rpc = None
+        self.app = None
+        self.pid = None
+        self.docs_converted = 0
+
+    def start(self):
+        create_instance, get_application, _, name = APP_KINDS[self.kind]
+        with spawn_lock:
+            os.environ.update(self.environ)
+            hr, self.rpc = create_instance()
+            if hr != S_OK:
+                raise ConvertException("Can't create the rpc instance", hr)
+            hr, self.app = getattr(self.rpc, get_application)()
+            if hr != S_OK:
+                raise ConvertException("Can't get the application", hr)
+        # 获取实例pid，供健康检查和销毁用
+        hr, self.pid = self.rpc.getProcessPid()
+        if hr != S_OK:
+            raise ConvertException("Can't  get the PID", hr)
+        print(f"{name} instance's PID:{self.pid}")
+        if self.kind != "wpp":
+            self.app.Visible = False
+
+    def is_healthy(self):
+        """进程仍在运行，且应用对象能正常响应 rpc 调用"""
+        if self.pid is None or not pid_alive(self.pid):
+            return False
+        try:
+            getattr(self.app, APP_KINDS[self.kind][2]).Count
+        except Exception:
+            return False
+        return True
+
+    def quit(self):
+        if self.app is not None:
+            try:
+                self.app.Quit()
+            except Exception:
+                pass
+        if self.pid is not None:
+            kill_pid(self.pid)
+        self.app = self.rpc = self.pid = None
+
+
+class OfficePool:
+    def __init__(self, environ, max_docs=POOL_MAX_DOCS):
+        """
+        :param environ: 启动实例时使用的环境变量（DISPLAY、HOME）
+        :param max_docs: 单个实例最多转换的文档数，达到后回收重建
+        """
+        self.environ = environ
+        self.max_docs = max_docs
+        self.idle = {kind: [] for kind in APP_KINDS}
+        self.lock = threading.Lock()
+        # 健康检查中（暂时移出 idle）的实例数；检查结束时通知等待的 checkout
+        self.checking = {kind: 0 for kind in APP_KINDS}
+        self.checked = threading.Condition(self.lock)
+
+    def checkout(self, kind):
+        """借出一个健康的实例；池中没有可用实例时新建一个（正在健康检查的实例先等其检查完）。"""
+        while True:
+            with self.lock:
+                while not self.idle[kind] and self.checking[kind]:
+                    self.checked.wait()
+                instance = self.idle[kind].pop() if self.idle[kind] else None
+            if instance is None:
+                instance = OfficeInstance(kind, self.environ)
+                try:
+                    with stage("instance_start"):
+                        instance.start()
+                except Exception:
+                    instance.quit()
+                    raise
+                return instance
+            if instance.is_healthy():
+                return instance
+            # 已崩溃的实例直接丢弃，继续取下一个
+            OFFICE_RESTARTS.labels(kind, "unhealthy").inc()
+            instance.quit()
+
+    def checkin(self, instance, failed=False):
+        """归还实例；出错、达到转换上限或已不健康的实例直接回收。"""
+        instance.docs_converted += 1
+        if failed:
+            reason = "error"
+        elif instance.docs_converted >= self.max_docs:
+            reason = "recycled"
+        elif not instance.is_healthy():
+            reason = "unhealthy"
+        else:
+            reason = None
+        if reason is not None:
+            OFFICE_RESTARTS.labels(instance.kind, reason).inc()
+            instance.quit()
+            return
+        with self.lock:
+            self.idle[instance.kind].append(instance)
+
+    @contextmanager
+    def instance(self, kind):
+        instance = self.checkout(kind)
+        failed = False
+        try:
+            yield instance
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.checkin(instance, failed)
+
+    def prewarm(self, kinds):
+        for kind in kinds:
+            instance = self.checkout(kind)
+            with self.lock:
+                self.idle[kind].append(instance)
+
+    def health_check(self):
+        """
+        剔除池中已崩溃的空闲实例。逐个移出检查，其余实例仍可借出；
+        同类型的实例都在检查中时 checkout 等待检查结果，而不是新建实例
+        """
+        for kind in APP_KINDS:
+            with self.lock:
+                instances = list(self.idle[kind])
+            for instance in instances:
+                with self.lock:
+                    if instance not in self.idle[kind]:
+                        # 已被借出
+                        continue
+                    self.idle[kind].remove(instance)
+                    self.checking[kind] += 1
+                healthy = False
+                try:
+                    healthy = instance.is_healthy()
+                finally:
+                    with self.lock:
+                        self.checking[kind] -= 1
+                        if healthy:
+                            self.idle[kind].append(instance)
+                        self.checked.notify_all()
+                if not healthy:
+                    print(f"Drop unhealthy {kind} instance, PID:{instance.pid}")
+                    OFFICE_RESTARTS.labels(kind, "unhealthy").inc()
+                    instance.quit()
+
+    def idle_counts(self):
+        with self.lock:
+            return {kind: len(instances) for kind, instances in self.idle.items()}
+
+    def drain(self):
+        """关闭池中所有空闲实例"""
+        with self.lock:
+            instances = [i for kind_instances in self.idle.values() for i in kind_instances]
+            for kind_instances in self.idle.values():
+                kind_instances.clear()
+        for instance in instances:
+            instance.quit()
+
+
+# ------------------------------------------------------------------------------
+# 转换截止时间与毒文件隔离区
+# 超过截止时间的转换由看门狗强制结束 WPS 进程，输入文件的哈希记入隔离区，
+# 之后再次提交相同内容的文件时直接失败，不再占用 worker
+# ------------------------------------------------------------------------------
+# 默认截止时间（秒）
+DEADLINE_DEFAULT = float(os.environ.get("WPS_DEADLINE", "60"))
+# 按源格式覆盖截止时间，如 "dps=120,et=90"
+DEADLINES = {
+    fmt.strip(): float(seconds)
+    for fmt, _, seconds in (item.partition("=") for item in os.environ.get("WPS_DEADLINES", "").split(",") if item)
+}
+QUARANTINE_DIR = os.environ.get("QUARANTINE_DIR", "/tmp/wps-quarantine")
+QUARANTINE_TTL = float(os.environ.get("QUARANTINE_TTL", str(7 * 24 * 3600)))
+
+
+def deadline_for(source_type):
+    return DEADLINES.get(source_type, DEADLINE_DEFAULT)
+
+
+@contextmanager
+def watchdog(instance, deadline):
+    """超过 deadline 秒仍未结束时强制结束实例进程，使阻塞中的 rpc 调用返回，随后抛出 DeadlineExceeded"""
+    fired = threading.Event()
+
+    def kill():
+        fired.set()
+        print(f"Conversion exceeded {deadline:g}s, killing PID:{instance.pid}")
+        if instance.pid is not None:
+            kill_pid(instance.pid)
+
+    timer = threading.Timer(deadline, kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    except Exception:
+        if fired.is_set():
+            raise DeadlineExceeded(f"Conversion exceeded the {deadline:g}s deadline") from None
+        raise
+    finally:
+        timer.cancel()
+    if fired.is_set():
+        raise DeadlineExceeded(f"Conversion exceeded the {deadline:g}s deadline")
+
+
+# 毒文件隔离区（见 docconv_common）
+quarantine = Quarantine(QUARANTINE_DIR, QUARANTINE_TTL)
 
-def getRpcPid(name,rpc):
-    global pid
-    hr, pid = rpc.getProcessPid()
-    if hr != S_OK:
-        raise ConvertException("Can't  get the PID", hr)
-    print(f"{name} instance's PID:{pid}")
 # ------------------------------------------------------------------------------
-# 文件转换函数（转换期间自动启动/刷新 Xvfb，并在结束后调度关闭）
+# 转换 worker：每个 worker 独占一个 Xvfb 显示、HOME 目录和一组 WPS 实例
 # ------------------------------------------------------------------------------
-def convert_file(input_file, output_file, target_format):
-    with conversion_lock:
+# worker 数量，即可同时进行的转换数
+WORKER_COUNT = int(os.environ.get("WPS_WORKERS", "1"))
+# 各 worker 的 HOME 目录所在位置
+WORKER_HOME_ROOT = os.environ.get("WPS_WORKER_HOME", "/tmp/wps-workers")
+# 镜像中预置的 WPS 配置（见 Dockerfile），复制到每个 worker 的 HOME 下
+KINGSOFT_CONFIG = "/root/.config/Kingsoft"
+
+
+class WpsWorker:
+    def __init__(self, index):
+        self.index = index
+        self.display = f":{99 + index}"
+        self.home = os.path.join(WORKER_HOME_ROOT, str(index))
+        self.xvfb = XvfbManager(display=self.display,
+                                idle_timeout=float(os.environ.get("XVFB_IDLE_TIMEOUT", "10")),
+                                max_idle_timeout=float(os.environ.get("XVFB_IDLE_TIMEOUT_MAX", "600")),
+                                start_timeout=float(os.environ.get("XVFB_START_TIMEOUT", "10")))
+        self.pool = OfficePool({"DISPLAY": self.display, "HOME": self.home})
+        # Xvfb 关闭前先退出池中的实例，避免留下失去显示的 WPS 进程
+        self.xvfb.on_shutdown.append(self.pool.drain)
+        self.busy = False
+        self.prepare_home()
+
+    def prepare_home(self):
+        config_dir = os.path.join(self.home, ".config", "Kingsoft")
+        os.makedirs(config_dir, exist_ok=True)
+        if os.path.isdir(KINGSOFT_CONFIG):
+            shutil.copytree(KINGSOFT_CONFIG, config_dir, dirs_exist_ok=True)
+
+    def convert(self, input_file, outputs):
+        """
+        在本 worker 上转换（转换期间自动启动/刷新 Xvfb，并在结束后调度关闭）。
+        outputs 为 目标格式 => 输出路径：文档只打开一次，依次另存为各目标格式。
+        """
         # 启动或刷新 Xvfb
-        xvfb_manager.start_if_not_running()
+        self.xvfb.start_if_not_running()
         try:
             ext = input_file.rsplit('.', 1)[-1].lower()
-            hr = S_OK  # 初始化返回码
-
-            if ext in ['doc', 'docx', 'rtf', 'html', 'pdf', 'xml', 'wps']:
-                hr, rpc = createWpsRpcInstance()
-                if hr != S_OK:
-                    raise ConvertException("Can't create the rpc instance", hr)
-                hr, app_instance = rpc.getWpsApplication()
-                if hr != S_OK:
-                    raise ConvertException("Can't get the application", hr)
-                # ------------------------------------------------------------------------------
-                # 获取实例pid，供销毁用
-                # ------------------------------------------------------------------------------
-                getRpcPid("Word",rpc)
-
-                app_instance.Visible = False
-                docs = app_instance.Documents
-                hr, doc = docs.Open(input_file, ReadOnly=True)
-                if hr != S_OK:
-                    app_instance.Quit()
-                    raise ConvertException("Failed to open document", hr)
-                hr = doc.SaveAs2(output_file, FileFormat=formats[target_format])
-                doc.Close(wpsapi.wdDoNotSaveChanges)
-                app_instance.Quit()
-
-            elif ext in ['ppt', 'pptx', 'dps']:
-                hr, rpc = createWppRpcInstance()
-                if hr != S_OK:
-                    raise ConvertException("Can't create the rpc instance", hr)
-                hr, app_instance = rpc.getWppApplication()
-                if hr != S_OK:
-                    raise ConvertException("Can't get the application", hr)
-                # ------------------------------------------------------------------------------
-                # 获取实例pid，供销毁用
-                # ------------------------------------------------------------------------------
-                getRpcPid("PowerPoint",rpc)
-
-                presentations = app_instance.Presentations
-                hr, presentation = presentations.Open(input_file, WithWindow=False)
-                if hr != S_OK:
-                    app_instance.Quit()
-                    raise ConvertException("Failed to open presentation", hr)
-                hr = presentation.SaveAs(output_file, FileFormat=formats[target_format])
-                presentation.Close()
-                app_instance.Quit()
-
-            elif ext in ['xls', 'xlsx', 'csv', 'et']:
-                hr, rpc = createEtRpcInstance()
-                if hr != S_OK:
-                    raise ConvertException("Can't create the rpc instance", hr)
-                hr, app_instance = rpc.getEtApplication()
-                if hr != S_OK:
-                    raise ConvertException("Can't get the application", hr)
-                # ------------------------------------------------------------------------------
-                # 获取实例pid，供销毁用
-                # ------------------------------------------------------------------------------
-                getRpcPid("Excel",rpc)
-                app_instance.Visible = False
-                workbooks = app_instance.Workbooks
-                hr, workbook = workbooks.Open(input_file)
-                if hr != S_OK:
-                    app_instance.Quit()
-                    raise ConvertException("Failed to open workbook", hr)
-                hr = workbook.SaveAs(output_file, FileFormat=formats[target_format])
-                workbook.Close()
-                app_instance.Quit()
+            kind = SOURCE_KINDS.get(ext)
+            if kind is None:
+                raise ConvertException(f"Unsupported source type {ext}", 0)
 
-            if hr != S_OK:
-                raise ConvertException("Failed to save file", hr)
+            # 截止时间按一次打开加每个目标格式各一次保存放宽
+            with self.pool.instance(kind) as instance, watchdog(instance, deadline_for(ext) * len(outputs)):
+                app_instance = instance.app
+                if kind == "wps":
+                    with stage("open"):
+                        hr, doc = app_instance.Documents.Open(input_file, ReadOnly=True)
+                    if hr != S_OK:
+                        raise ConvertException("Failed to open document", hr)
+                    save = doc.SaveAs2
+                    close = lambda: doc.Close(wpsapi.wdDoNotSaveChanges)
+
+                elif kind == "wpp":
+                    with stage("open"):
+                        hr, presentation = app_instance.Presentations.Open(input_file, WithWindow=False)
+                    if hr != S_OK:
+                        raise ConvertException("Failed to open presentation", hr)
+                    save = presentation.SaveAs
+                    close = presentation.Close
+
+                else:
+                    with stage("open"):
+                        hr, workbook = app_instance.Workbooks.Open(input_file)
+                    if hr != S_OK:
+                        raise ConvertException("Failed to open workbook", hr)
+                    save = workbook.SaveAs
+                    close = workbook.Close
+
+                try:
+                    for target_format in sorted(outputs, key=lambda t: t in LOSSY_FORMATS):
+                        with stage("save"):
+                            hr = save(outputs[target_format], FileFormat=formats[target_format])
+                        if hr != S_OK:
+                            raise ConvertException(f"Failed to save file as {target_format}", hr)
+                finally:
+                    close()
+        except DeadlineExceeded:
+            # 被结束的实例已由实例池回收，后台补充一个新实例
+            threading.Thread(target=self.pool.prewarm, args=([kind],), daemon=True).start()
+            raise
         finally:
-            # 无论转换成功与否，都调度10秒后关闭 Xvfb（如果10秒内无新的转换请求，该进程将被终止）
-            xvfb_manager.schedule_shutdown()
+            # 无论转换成功与否，都调度关闭 Xvfb（如果空闲期内无新的转换请求，Xvfb 与池中实例将被关闭）
+            self.xvfb.schedule_shutdown()
+
+    def prewarm(self, kinds):
+        self.xvfb.start_if_not_running(arrival=False)
+        try:
+            self.pool.prewarm(kinds)
+        finally:
+            self.xvfb.schedule_shutdown()
+
+    def status(self):
+        running = self.xvfb.process is not None
+        return {
+            "index": self.index,
+            "busy": self.busy,
+            "xvfb": running,
+            "idle": self.pool.idle_counts() if running else dict.fromkeys(APP_KINDS, 0),
+            "idleTimeout": round(self.xvfb.current_timeout, 1),
+        }
+
+
+class WorkerPool:
+    def __init__(self, size):
+        self.workers = [WpsWorker(i) for i in range(size)]
+        # 后进先出：轻载时优先复用刚用过、仍处于预热状态的 worker
+        self.free = queue.LifoQueue()
+        for worker in reversed(self.workers):
+            self.free.put(worker)
+        # 等待空闲 worker 的转换数，由 /ready 报告给网关
+        self.queued = 0
+        self.queued_lock = threading.Lock()
+
+    @contextmanager
+    def worker(self):
+        """借出一个空闲 worker，全部繁忙时排队等待"""
+        WORKER_QUEUE.inc()
+        with self.queued_lock:
+            self.queued += 1
+        try:
+            with stage("queue_wait"):
+                worker = self.free.get()
+        finally:
+            WORKER_QUEUE.dec()
+            with self.queued_lock:
+                self.queued -= 1
+        WORKERS_BUSY.inc()
+        worker.busy = True
+        try:
+            yield worker
+        finally:
+            worker.busy = False
+            WORKERS_BUSY.dec()
+            self.free.put(worker)
+
+worker_pool = WorkerPool(WORKER_COUNT)
 
 # ------------------------------------------------------------------------------
-# API 路由：转换接口
+# 内存预算与大文件通道。
+# /convert 的请求体（base64）不超过阈值且内存预算有余量时整块读入内存解码，否则落盘后分块解码；
+# 结果以分块 base64 编码的 JSON 流式返回。不小于 LARGE_FILE_BYTES 的文件同时最多占用 LARGE_WORKERS 个 worker，
+# 其余 worker 留给小文件
 # ------------------------------------------------------------------------------
-@app.post("/convert")
-def convert(request: ConvertRequest):
-    if request.sourceType not in formats or request.targetType not in formats:
-        return {"status": "error", "message": "Unsupported file type"}
-    if request.sourceType == "dps" and request.targetType == "pdf":
-        return {"status": "error", "message": "不支持dps（演示文稿）转换为pdf!"}
+SPOOL_MEMORY_THRESHOLD = int(os.environ.get("SPOOL_MEMORY_THRESHOLD", str(8 * 1024 ** 2)))
+MEMORY_BUDGET = int(os.environ.get("MEMORY_BUDGET", str(128 * 1024 ** 2)))
+LARGE_FILE_BYTES = int(os.environ.get("LARGE_FILE_BYTES", str(20 * 1024 ** 2)))
+LARGE_WORKERS = int(os.environ.get("WPS_LARGE_WORKERS", str(max(WORKER_COUNT // 2, 1))))
+# 分块编码时每次读取的字节数，为 3 的倍数，各块的编码结果可直接拼接
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+
+large_lane = threading.BoundedSemaphore(LARGE_WORKERS)
+memory_budget = MemoryBudget(MEMORY_BUDGET, MEMORY_RESERVED)
+
+
+@contextmanager
+def file_lane(input_file):
+    """大文件先占用大文件通道的名额，再借出 worker"""
+    if os.path.getsize(input_file) < LARGE_FILE_BYTES:
+        yield
+        return
+    LARGE_LANE_QUEUE.inc()
+    try:
+        with stage("large_lane_wait"):
+            large_lane.acquire()
+    finally:
+        LARGE_LANE_QUEUE.dec()
+    try:
+        yield
+    finally:
+        large_lane.release()
 
+# ------------------------------------------------------------------------------
+# 文件转换函数：交给任意一个空闲 worker 执行
+# ------------------------------------------------------------------------------
+def convert_file(input_file, outputs):
+    """outputs 为 目标格式 => 输出路径"""
+    source_type = input_file.rsplit('.', 1)[-1].lower()
+    result = "error"
     try:
-        file_data = base64.b64decode(request.fileBytes)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{request.sourceType}") as temp_input:
-            temp_input.write(file_data)
-            temp_input_path = temp_input.name
+        digest = file_digest(input_file)
+        entry = quarantine.check(digest)
+        if entry is not None:
+            result = "quarantined"
+            raise Quarantined(f"Document is quarantined: {entry['reason']}")
+        with file_lane(input_file), worker_pool.worker() as worker:
+            try:
+                worker.convert(input_file, outputs)
+            except DeadlineExceeded as e:
+                result = "deadline"
+                quarantine.add(digest, str(e))
+                raise
+        result = "ok"
+    finally:
+        for target_format in outputs:
+            # 指标标签只使用支持的格式，避免客户端填写的任意值产生无限的时间序列
+            CONVERSIONS.labels(source_type if source_type in formats else "other",
+                               target_format if target_format in formats else "other", result).inc()
+
+# ------------------------------------------------------------------------------
+# API 路由：转换接口
+# ------------------------------------------------------------------------------
+def check_conversion(source_type, target_type):
+    """返回不支持该转换的原因，支持时返回 None"""
+    if source_type not in formats or target_type not in formats:
+        return "Unsupported file type"
+    if source_type == "dps" and target_type == "pdf":
+        return "不支持dps（演示文稿）转换为pdf!"
+    return None
+
+def parse_targets(target_type):
+    """targetType 可以是单个格式、逗号分隔的多个格式或格式列表，返回去重后的列表"""
+    items = target_type if isinstance(target_type, list) else target_type.split(",")
+    return list(dict.fromkeys(t.strip() for t in items if t.strip()))
+
+def check_targets(source_type, targets):
+    if not targets:
+        return "Missing target type"
+    for target_type in targets:
+        error = check_conversion(source_type, target_type)
+        if error:
+            return error
+    return None
+
+def body_validation_error(e):
+    """与 FastAPI 自行解析请求体时的 422 响应保持一致"""
+    return RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors()])
 
-        temp_output_path = temp_input_path.replace(f".{request.sourceType}", f".{request.targetType}")
+async def spool_json_request(request):
+    """
+    读取 /convert 的 JSON 请求体，将 fileBytes 解码写入临时文件，返回 (请求对象，其 fileBytes 已清空；文件路径)。
+    base64 内容有误时抛出 ValueError，请求体不符合 ConvertRequest 时抛出 RequestValidationError
+    """
+    length = int(request.headers.get("content-length") or 0)
+    # 请求体、解析出的 base64 字符串与解码后的内容同时在内存中，约为请求体的 3 倍
+    reserved = 3 * length
+    if 0 < length <= SPOOL_MEMORY_THRESHOLD and memory_budget.try_reserve(reserved):
         try:
-            convert_file(temp_input_path, temp_output_path, request.targetType)
-        except Exception as e:
-            print(e)
+            with stage("upload"):
+                body = await request.body()
+            with stage("decode"):
+                try:
+                    parsed = ConvertRequest.model_validate_json(body)
+                except ValidationError as e:
+                    raise body_validation_error(e)
+                file_data = base64.b64decode(parsed.fileBytes)
+            parsed.fileBytes = ""
+            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{parsed.sourceType}") as temp_input:
+                temp_input.write(file_data)
+            return parsed, temp_input.name
         finally:
-            if pid is not None:
-                subprocess.call("kill -9 {}".format(pid), shell=True)
+            memory_budget.release(reserved)
 
-        with open(temp_output_path, "rb") as output_file:
-            converted_file_data = base64.b64encode(output_file.read()).decode("utf-8")
+    SPOOLED_BODIES.inc()
+    with stage("upload"), tempfile.NamedTemporaryFile(delete=False, suffix=".json") as temp_body:
+        async for chunk in request.stream():
+            temp_body.write(chunk)
+    temp_data_path = f"{temp_body.name}.upload"
+    try:
+        with stage("decode"):
+            try:
+                fields, _ = await run_in_threadpool(decode_json_file_field, temp_body.name, "fileBytes", temp_data_path)
+            except json.JSONDecodeError as e:
+                raise RequestValidationError([{"type": "json_invalid", "loc": ("body",), "msg": str(e)}])
+            try:
+                parsed = ConvertRequest.model_validate(fields)
+            except ValidationError as e:
+                raise body_validation_error(e)
+        temp_input_path = f"{temp_body.name}.{parsed.sourceType}"
+        os.replace(temp_data_path, temp_input_path)
+        return parsed, temp_input_path
+    finally:
+        remove_files(temp_body.name, temp_data_path)
 
+def iter_base64_json(outputs):
+    """
+    以 JSON 流式返回转换结果，文件内容分块 base64 编码：单个目标格式时为 {"status": "ok", "fileBytes": ...}，
+    多个目标格式时为 {"status": "ok", "files": {目标格式: ...}}
+    """
+    if len(outputs) == 1:
+        parts = [(b'{"status": "ok", "fileBytes": "', next(iter(outputs.values())))]
+        end = b'"}'
+    else:
+        parts = [((b'{"status": "ok", "files": {' if i == 0 else b'", ') + json.dumps(target).encode() + b': "', path)
+                 for i, (target, path) in enumerate(outputs.items())]
+        end = b'"}}'
+    # encode 阶段只计编码耗时，不含发送
+    elapsed = 0
+    for head, path in parts:
+        yield head
+        with open(path, "rb") as output_file:
+            while chunk := output_file.read(BASE64_CHUNK_SIZE):
+                start = time.perf_counter()
+                encoded = base64.b64encode(chunk)
+                elapsed += time.perf_counter() - start
+                yield encoded
+    STAGE_SECONDS.labels("encode").observe(elapsed)
+    # 响应头已发出，encode 阶段只出现在耗时日志中
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record("encode", elapsed)
+    yield end
+
+@app.post("/convert", openapi_extra={"requestBody": {"required": True, "content": {
+    "application/json": {"schema": ConvertRequest.model_json_schema()}}}})
+async def convert(http_request: Request):
+    try:
+        request, temp_input_path = await spool_json_request(http_request)
+    except (ValueError, binascii.Error) as e:
+        return {"status": "error", "message": str(e)}
+    annotate(source=request.sourceType, target=request.targetType, bytes=os.path.getsize(temp_input_path))
+    targets = parse_targets(request.targetType)
+    error = check_targets(request.sourceType, targets)
+    if error:
         os.remove(temp_input_path)
-        os.remove(temp_output_path)
+        return {"status": "error", "message": error}
 
-        return {"status": "ok", "fileBytes": converted_file_data}
+    temp_outputs = {
+        target: temp_input_path.replace(f".{request.sourceType}", f".{target}") for target in targets
+    }
+    try:
+        try:
+            await run_in_threadpool(convert_file, temp_input_path, temp_outputs)
+        except (DeadlineExceeded, Quarantined):
+            raise
+        except Exception as e:
+            # 转换报错但已生成输出文件时仍返回结果
+            print(e)
+        for temp_output_path in temp_outputs.values():
+            if not os.path.exists(temp_output_path):
+                raise RuntimeError("转换未生成输出文件")
     except Exception as e:
+        print(e)
+        remove_files(*temp_outputs.values())
         return {"status": "error", "message": str(e)}
+    finally:
+        os.remove(temp_input_path)
+    # 多个目标格式时 files 为 目标格式 => Base64 编码的文件内容；结果边编码边发送，不整块读入内存
+    return StreamingResponse(iter_base64_json(temp_outputs), media_type="application/json",
+                             background=BackgroundTask(remove_files, *temp_outputs.values()))
+
+# ------------------------------------------------------------------------------
+# API 路由：二进制流式转换接口
+# 请求体为原始文件内容（或 multipart 表单的 file 字段），sourceType/targetType 通过查询参数传递；
+# 成功时直接返回转换后的文件（targetType 为逗号分隔的多个格式时返回 zip，其中为 converted.<格式>），
+# 失败时返回非 200 状态码及 {"status": "error", "message": ...}
+# ------------------------------------------------------------------------------
+def remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+async def spool_upload(request, suffix):
+    """将请求体边接收边写入临时文件，返回文件路径"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{suffix}") as temp_input:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None or isinstance(upload, str):
+                temp_input.close()
+                os.remove(temp_input.name)
+                raise ValueError("multipart 请求缺少 file 字段")
+            while chunk := await upload.read(SPOOL_CHUNK_SIZE):
+                temp_input.write(chunk)
+        else:
+            async for chunk in request.stream():
+                temp_input.write(chunk)
+        return temp_input.name
+
+def write_targets_archive(outputs, archive_path):
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for target, path in outputs.items():
+            archive.write(path, f"converted.{target}")
+
+@app.post("/convert/stream")
+async def convert_stream(request: Request, sourceType: str, targetType: str):
+    targets = parse_targets(targetType)
+    error = check_targets(sourceType, targets)
+    if error:
+        return JSONResponse(status_code=422, content={"status": "error", "message": error})
+    try:
+        with stage("upload"):
+            temp_input_path = await spool_upload(request, sourceType)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+
+    annotate(source=sourceType, target=targetType, bytes=os.path.getsize(temp_input_path))
+    stem = temp_input_path.rsplit('.', 1)[0]
+    temp_outputs = {target: f"{stem}.{target}" for target in targets}
+    try:
+        await run_in_threadpool(convert_file, temp_input_path, temp_outputs)
+        for temp_output_path in temp_outputs.values():
+            if not os.path.exists(temp_output_path):
+                raise RuntimeError("转换未生成输出文件")
+        if len(targets) > 1:
+            temp_output_path = f"{stem}.zip"
+            await run_in_threadpool(write_targets_archive, temp_outputs, temp_output_path)
+            remove_files(*temp_outputs.values())
+        else:
+            temp_output_path = temp_outputs[targets[0]]
+    except Exception as e:
+        print(e)
+        remove_files(temp_input_path, *temp_outputs.values(), f"{stem}.zip")
+        if isinstance(e, DeadlineExceeded):
+            status_code = 504
+        elif isinstance(e, Quarantined):
+            status_code = 422
+        else:
+            status_code = 500
+        return JSONResponse(status_code=status_code, content={"status": "error", "message": str(e)})
+
+    media_type = "application/zip" if len(targets) > 1 else "application/octet-stream"
+    return FileResponse(temp_output_path, media_type=media_type,
+                        background=BackgroundTask(remove_files, temp_input_path, temp_output_path))
+
+# ------------------------------------------------------------------------------
+# API 路由：就绪与热容量
+# 启动预热完成前返回 503；warm 为各实例类型当前可立即转换（worker 空闲、Xvfb 与该类型实例已启动）的 worker 数，
+# 网关据此优先把请求发往有热容量的后端
+# ------------------------------------------------------------------------------
+prewarmed = threading.Event()
+
+@app.get("/ready")
+def ready():
+    workers = [worker.status() for worker in worker_pool.workers]
+    warm = {kind: sum(1 for w in workers if not w["busy"] and w["idle"][kind]) for kind in APP_KINDS}
+    content = {
+        "ready": prewarmed.is_set(),
+        "warm": warm,
+        "freeWorkers": sum(1 for w in workers if not w["busy"]),
+        "queued": worker_pool.queued,
+        "workers": workers,
+    }
+    return JSONResponse(status_code=200 if prewarmed.is_set() else 503, content=content)
+
+@app.get("/metrics")
+def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 # ------------------------------------------------------------------------------
 # 后台线程：每 3 秒检测并结束 /opt/kingsoft/wps-office/office6/wpscloudsvr 进程
@@ -254,6 +951,34 @@ def monitor_wpscloudsvr():
         subprocess.call(["pkill", "-f", "/opt/kingsoft/wps-office/office6/wpscloudsvr"])
         time.sleep(3)
 
+# ------------------------------------------------------------------------------
+# 后台线程：定期检查实例池，剔除已崩溃的实例
+# ------------------------------------------------------------------------------
+def monitor_office_pool():
+    while True:
+        time.sleep(POOL_HEALTH_INTERVAL)
+        for worker in worker_pool.workers:
+            try:
+                worker.pool.health_check()
+            except Exception as e:
+                print(f"worker {worker.index} 实例池健康检查失败：", e)
+
+def prewarm_office_pool():
+    with worker_pool.worker() as worker:
+        try:
+            worker.prewarm(POOL_PREWARM)
+        except Exception as e:
+            print(f"worker {worker.index} 实例池预热失败：", e)
+
+def prewarm_workers():
+    """启动时预热所有 worker 的 Xvfb 与实例（每个线程同时持有不同的 worker），完成后标记服务就绪"""
+    threads = [threading.Thread(target=prewarm_office_pool, daemon=True) for _ in worker_pool.workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    prewarmed.set()
+
 # ------------------------------------------------------------------------------
 # 主程序入口
 # ------------------------------------------------------------------------------
@@ -261,4 +986,6 @@ if __name__ == "__main__":
     # 启动监控线程（守护线程，主程序退出时自动结束）
     monitor_thread = threading.Thread(target=monitor_wpscloudsvr, daemon=True)
     monitor_thread.start()
+    threading.Thread(target=monitor_office_pool, daemon=True).start()
+    threading.Thread(target=prewarm_workers, daemon=True).start()
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,12 @@
+"""
+pywpsrpc 的替身，仅实现 WPS_Server/server.py 用到的接口，用于在没有 WPS Office 的机器上压测。
+
+每个 rpc 实例启动一个 sleep 子进程充当 WPS 进程（供 PID 健康检查与强制结束），
+打开/保存文档只按设定的延迟等待，保存时原样复制输入文件。延迟通过环境变量调整：
+
+- FAKE_WPS_STARTUP：创建实例的耗时（秒），默认 0.5
+- FAKE_WPS_OPEN：打开文档的耗时（秒），默认 0.05
+- FAKE_WPS_SAVE：保存文档的耗时（秒），默认 0.1
+- FAKE_WPS_PER_MB：每 MB 输入额外增加的保存耗时（秒），默认 0
+- FAKE_WPS_JITTER：耗时的随机波动比例，默认 0
+"""
@@ -0,0 +1,75 @@
+import os
+import random
+import shutil
+import subprocess
+import time
+
+from .common import E_FAIL, S_OK
+
+
+def _delay(name, default, size=0):
+    seconds = float(os.environ.get(name, default))
+    seconds += float(os.environ.get("FAKE_WPS_PER_MB", "0")) * size / (1024 * 1024)
+    jitter = float(os.environ.get("FAKE_WPS_JITTER", "0"))
+    time.sleep(max(seconds * (1 + random.uniform(-jitter, jitter)), 0))
+
+
+class Document:
+    def __init__(self, path):
+        self.path = path
+
+    def _save(self, output_file, FileFormat=None):
+        _delay("FAKE_WPS_SAVE", "0.1", os.path.getsize(self.path))
+        shutil.copyfile(self.path, output_file)
+        return S_OK
+
+    SaveAs = SaveAs2 = _save
+
+    def Close(self, *args):
+        pass
+
+
+class Documents:
+    def __init__(self):
+        self.open = []
+
+    @property
+    def Count(self):
+        return len(self.open)
+
+    def Open(self, path, *args, **kwargs):
+        _delay("FAKE_WPS_OPEN", "0.05")
+        if not os.path.exists(path):
+            return E_FAIL, None
+        return S_OK, Document(path)
+
+
+class Application:
+    def __init__(self, process):
+        self.process = process
+        self.Visible = True
+        self.Documents = self.Presentations = self.Workbooks = Documents()
+
+    def Quit(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class RpcInstance:
+    def __init__(self):
+        _delay("FAKE_WPS_STARTUP", "0.5")
+        # 充当 WPS 进程，供 PID 健康检查与看门狗强制结束
+        self.process = subprocess.Popen(["sleep", "infinity"])
+        self.app = Application(self.process)
+
+    def getProcessPid(self):
+        return S_OK, self.process.pid
+
+    def _get_application(self):
+        return S_OK, self.app
+
+    getWpsApplication = getWppApplication = getEtApplication = _get_application
+
+
+def create_instance():
+    return S_OK, RpcInstance()
@@ -0,0 +1,2 @@
+S_OK = 0
+E_FAIL = 0x80004005
@@ -0,0 +1,9 @@
+from types import SimpleNamespace
+
+from ._fake import create_instance as createEtRpcInstance
+
+etapi = SimpleNamespace(
+    xlExcel8=56,
+    xlOpenXMLWorkbook=51,
+    xlCSV=6,
+)
@@ -0,0 +1,8 @@
+from types import SimpleNamespace
+
+from ._fake import create_instance as createWppRpcInstance
+
+wppapi = SimpleNamespace(
+    ppSaveAsPresentation=1,
+    ppSaveAsOpenXMLPresentation=24,
+)
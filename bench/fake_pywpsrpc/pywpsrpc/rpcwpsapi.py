@@ -0,0 +1,13 @@
+from types import SimpleNamespace
+
+from ._fake import create_instance as createWpsRpcInstance
+
+wpsapi = SimpleNamespace(
+    wdFormatDocument=0,
+    wdFormatXMLDocument=12,
+    wdFormatRTF=6,
+    wdFormatHTML=8,
+    wdFormatPDF=17,
+    wdFormatXML=11,
+    wdDoNotSaveChanges=0,
+)
@@ -0,0 +1,78 @@
+"""
+模拟 unoserver 的 XML-RPC 服务（API 版本 3），不依赖 LibreOffice。
+info()/convert() 的签名与 unoserver 一致，转换只是按设定的延迟等待后原样返回输入内容，
+用于在普通 Linux 机器上测量网关自身的开销（base64、线程池、路由、落盘等）。
+
+与真实 unoserver 一样单线程处理请求，同一实例上的转换依次排队。
+
+    python bench/fake_unoserver.py --port 2003 --latency 0.2 --jitter 0.1 --per-mb 0.05
+"""
+import argparse
+import os
+import random
+import time
+import xmlrpc.client
+from xmlrpc.server import SimpleXMLRPCServer
+
+API_VERSION = "3"
+
+IMPORT_FILTERS = ["MS Word 97", "MS Word 2007 XML", "MS Excel 97", "Calc MS Excel 2007 XML",
+                  "MS PowerPoint 97", "Impress MS PowerPoint 2007 XML", "Text - txt - csv (StarCalc)"]
+EXPORT_FILTERS = ["MS Word 97", "MS Word 2007 XML", "writer_pdf_Export", "MS Excel 97",
+                  "Calc MS Excel 2007 XML", "calc_pdf_Export", "MS PowerPoint 97",
+                  "Impress MS PowerPoint 2007 XML", "impress_pdf_Export", "writer_png_Export"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake unoserver for benchmarks")
+    parser.add_argument("--interface", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2003)
+    parser.add_argument("--latency", type=float, default=0.1, help="每次转换的基础耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="耗时的随机波动比例，如 0.1 表示 ±10%%")
+    parser.add_argument("--per-mb", type=float, default=0.0, help="每 MB 输入额外增加的耗时（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="随机失败的比例（0~1）")
+    parser.add_argument("--crash-rate", type=float, default=0.0,
+                        help="转换中进程直接退出（模拟文档使 LibreOffice 崩溃）的比例（0~1）")
+    args = parser.parse_args()
+
+    def info():
+        return {
+            "unoserver": "fake",
+            "api": API_VERSION,
+            "import_filters": IMPORT_FILTERS,
+            "export_filters": EXPORT_FILTERS,
+        }
+
+    def convert(inpath=None, indata=None, outpath=None, convert_to=None, filtername=None,
+                filter_options=[], update_index=True, infiltername=None):
+        if indata is not None:
+            data = indata.data
+        else:
+            with open(inpath, "rb") as f:
+                data = f.read()
+        delay = args.latency + args.per_mb * len(data) / (1024 * 1024)
+        delay *= 1 + random.uniform(-args.jitter, args.jitter)
+        time.sleep(max(delay, 0))
+        if random.random() < args.crash_rate:
+            os._exit(1)
+        if random.random() < args.fail_rate:
+            raise RuntimeError("fake conversion failure")
+        if outpath is not None:
+            with open(outpath, "wb") as f:
+                f.write(data)
+            return None
+        return xmlrpc.client.Binary(data)
+
+    with SimpleXMLRPCServer((args.interface, args.port), allow_none=True, logRequests=False) as server:
+        server.register_introspection_functions()
+        server.register_function(info)
+        server.register_function(convert)
+        print(f"fake unoserver listening on {args.interface}:{args.port}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
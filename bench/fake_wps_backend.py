@@ -0,0 +1,21 @@
+"""
+用 pywpsrpc 替身（bench/fake_pywpsrpc）和 Xvfb 替身（bench/fake_bin/Xvfb）运行 WPS_Server/server.py，
+服务代码本身不做任何修改，监听 8000 端口。WPS 各步骤的耗时见 fake_pywpsrpc/pywpsrpc/__init__.py。
+
+    FAKE_WPS_SAVE=0.2 WPS_WORKERS=2 python bench/fake_wps_backend.py
+"""
+import os
+import runpy
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(BENCH_DIR, os.pardir, "WPS_Server", "server.py")
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(BENCH_DIR, "fake_pywpsrpc"))
+    # 镜像中 docconv_common.py 与 server.py 位于同一目录，这里从仓库根目录导入
+    sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir))
+    os.environ["PATH"] = os.path.join(BENCH_DIR, "fake_bin") + os.pathsep + os.environ["PATH"]
+    os.environ.setdefault("WPS_WORKER_HOME", "/tmp/bench-wps-workers")
+    os.environ.setdefault("QUARANTINE_DIR", "/tmp/bench-wps-quarantine")
+    runpy.run_path(SERVER, run_name="__main__")
@@ -0,0 +1,207 @@
+"""
+转换服务压测客户端：以固定并发向网关（或直接向 WPS 后端）发送转换请求，
+按格式对统计吞吐量与 p50/p95/p99 延迟。
+
+    python bench/loadgen.py --url http://127.0.0.1:8001 --pairs doc:docx,wps:pdf,et:xlsx \\
+        --concurrency 16 --requests 400 --mode stream --json-out result.json
+
+指定 --baseline 时与之前保存的结果比较，任一格式对的吞吐量下降或 p95 上升超过 --max-regression
+即以非 0 状态退出，可用于回归测试。
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import math
+import os
+import sys
+import time
+
+import httpx
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+# 仓库中自带的样例文件，其余格式使用随机内容（替身后端不解析内容）
+SAMPLE_FILES = {
+    "wps": os.path.join(REPO_DIR, "test", "test1.wps"),
+    "et": os.path.join(REPO_DIR, "test", "test.et"),
+    "dps": os.path.join(REPO_DIR, "test", "sub", "test.dps"),
+}
+
+
+def parse_size(value):
+    units = {"k": 1024, "m": 1024 ** 2}
+    value = value.strip().lower()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def percentile(sorted_values, p):
+    """最近秩法百分位数"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def load_inputs(pairs, size, overrides):
+    inputs = {}
+    for source, _ in pairs:
+        path = overrides.get(source) or SAMPLE_FILES.get(source)
+        if path:
+            with open(path, "rb") as f:
+                inputs[source] = f.read()
+        else:
+            inputs[source] = os.urandom(size)
+    return inputs
+
+
+async def send(client, args, source, target, data, seq):
+    if args.unique:
+        # 追加序号，使每次请求的内容不同，避开网关的结果缓存
+        data = data + f"\n{time.time_ns()}-{seq}".encode()
+    start = time.perf_counter()
+    try:
+        if args.mode == "json":
+            payload = {"fileBytes": base64.b64encode(data).decode(), "sourceType": source, "targetType": target}
+            r = await client.post(f"{args.url}/convert", json=payload)
+        else:
+            r = await client.post(f"{args.url}/convert/stream", content=data,
+                                  params={"sourceType": source, "targetType": target},
+                                  headers={"content-type": "application/octet-stream"})
+        ok = r.status_code == 200
+        if ok and r.headers.get("content-type", "").startswith("application/json"):
+            # 网关 JSON 接口失败时返回 200 + {"error"}，WPS 后端返回 {"status": ...}
+            body = r.json()
+            ok = "error" not in body and body.get("status", "ok") == "ok"
+        status = r.status_code
+    except httpx.HTTPError as e:
+        ok, status = False, type(e).__name__
+    return ok, status, time.perf_counter() - start
+
+
+async def run(args):
+    pairs = [tuple(p.split(":", 1)) for p in args.pairs.split(",")]
+    inputs = load_inputs(pairs, parse_size(args.size), dict(o.split("=", 1) for o in args.input))
+    schedule = itertools.cycle(pairs)
+    counter = itertools.count()
+    results = {pair: {"latencies": [], "errors": 0, "statuses": {}} for pair in pairs}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for _ in range(args.warmup):
+            source, target = next(schedule)
+            await send(client, args, source, target, inputs[source], next(counter))
+
+        deadline = time.perf_counter() + args.duration if args.duration else None
+        remaining = iter(range(args.requests)) if not args.duration else None
+
+        async def worker():
+            while True:
+                if deadline is not None:
+                    if time.perf_counter() >= deadline:
+                        return
+                elif next(remaining, None) is None:
+                    return
+                source, target = next(schedule)
+                ok, status, elapsed = await send(client, args, source, target, inputs[source], next(counter))
+                result = results[(source, target)]
+                result["statuses"][str(status)] = result["statuses"].get(str(status), 0) + 1
+                if ok:
+                    result["latencies"].append(elapsed)
+                else:
+                    result["errors"] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - start
+
+    report = {"wall": wall, "concurrency": args.concurrency, "mode": args.mode, "pairs": {}}
+    for (source, target), result in results.items():
+        latencies = sorted(result["latencies"])
+        report["pairs"][f"{source}:{target}"] = {
+            "ok": len(latencies),
+            "errors": result["errors"],
+            "statuses": result["statuses"],
+            "throughput": len(latencies) / wall,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        }
+    report["throughput"] = sum(p["throughput"] for p in report["pairs"].values())
+    return report
+
+
+def ms(value):
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+
+def print_report(report):
+    print(f"\n{report['mode']} mode, concurrency {report['concurrency']}, {report['wall']:.1f}s")
+    print(f"{'pair':<12}{'ok':>7}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, p in report["pairs"].items():
+        print(f"{name:<12}{p['ok']:>7}{p['errors']:>6}{p['throughput']:>9.1f}"
+              f"{ms(p['p50']):>10}{ms(p['p95']):>10}{ms(p['p99']):>10}{ms(p['max']):>10}")
+        if p["errors"]:
+            print(f"{'':<12}statuses: {p['statuses']}")
+    print(f"{'total':<12}{'':>13}{report['throughput']:>9.1f}")
+
+
+def compare(report, baseline, max_regression):
+    """返回相对基线退化超过阈值的项"""
+    regressions = []
+    for name, p in report["pairs"].items():
+        base = baseline["pairs"].get(name)
+        if not base:
+            continue
+        if base["throughput"] and p["throughput"] < base["throughput"] * (1 - max_regression):
+            regressions.append(f"{name} throughput {base['throughput']:.1f} -> {p['throughput']:.1f} req/s")
+        if base["p95"] and (p["p95"] is None or p["p95"] > base["p95"] * (1 + max_regression)):
+            regressions.append(f"{name} p95 {ms(base['p95'])} -> {ms(p['p95'])} ms")
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Conversion service load generator")
+    parser.add_argument("--url", default="http://127.0.0.1:8001", help="网关或 WPS 后端地址")
+    parser.add_argument("--pairs", default="doc:docx,xls:xlsx,wps:docx,dps:pptx",
+                        help="逗号分隔的 源格式:目标格式，请求按顺序轮流发送")
+    parser.add_argument("--mode", choices=["stream", "json"], default="stream",
+                        help="stream 使用 /convert/stream，json 使用 base64 的 /convert")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="请求总数（未指定 --duration 时）")
+    parser.add_argument("--duration", type=float, default=None, help="按时长压测（秒）")
+    parser.add_argument("--warmup", type=int, default=4, help="不计入统计的预热请求数")
+    parser.add_argument("--size", default="256k", help="无样例文件的格式使用的随机内容大小，如 64k、4m")
+    parser.add_argument("--input", action="append", default=[], metavar="EXT=PATH",
+                        help="指定某源格式使用的输入文件，可重复")
+    parser.add_argument("--unique", action="store_true", help="每次请求内容不同，避开结果缓存")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json-out", help="将结果保存为 JSON，可作为之后的 --baseline")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果比较")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="允许的退化比例（吞吐量下降 / p95 上升），默认 0.2")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for line in regressions:
+            print("REGRESSION:", line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+一键压测：启动若干个 unoserver 替身、WPS 后端（pywpsrpc 替身）、准入 broker 和网关，运行 loadgen 后全部关闭。
+未识别的参数原样传给 loadgen.py。
+
+    python bench/run.py --unoservers 4 --uno-latency 0.2 --wps-workers 2 --wps-save 0.2 \\
+        -- --pairs doc:docx,wps:docx --concurrency 16 --requests 400
+
+网关监听 --gateway-port（默认 8001），WPS 后端固定使用 8000 端口（与网关中的地址一致）。
+网关的结果缓存默认关闭，以测量每次转换的实际开销。
+"""
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.abspath(os.path.join(BENCH_DIR, os.pardir))
+WPS_PORT = 8000
+
+sys.path.insert(0, BENCH_DIR)
+import loadgen  # noqa: E402
+
+
+def wait_for_port(port, process, timeout=60):
+    """port 为 TCP 端口或 unix socket 路径"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with {process.returncode}")
+        try:
+            if isinstance(port, str):
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(port)
+            else:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"port {port} not ready after {timeout}s")
+
+
+def start(command, **kwargs):
+    # 每个服务单独一个进程组，结束时连同其子进程（WPS/Xvfb 替身）一起清理
+    return subprocess.Popen(command, start_new_session=True, **kwargs)
+
+
+def stop(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        pass
+    except ProcessLookupError:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the gateway and WPS backend against stand-in backends")
+    parser.add_argument("--unoservers", type=int, default=4, help="unoserver 替身数量")
+    parser.add_argument("--uno-port", type=int, default=2003, help="第一个 unoserver 替身的端口")
+    parser.add_argument("--uno-latency", type=float, default=0.1)
+    parser.add_argument("--uno-jitter", type=float, default=0.1)
+    parser.add_argument("--uno-per-mb", type=float, default=0.0)
+    parser.add_argument("--wps-workers", type=int, default=1)
+    parser.add_argument("--wps-startup", type=float, default=0.5)
+    parser.add_argument("--wps-open", type=float, default=0.05)
+    parser.add_argument("--wps-save", type=float, default=0.1)
+    parser.add_argument("--wps-per-mb", type=float, default=0.0)
+    parser.add_argument("--wps-jitter", type=float, default=0.1)
+    parser.add_argument("--gateway-port", type=int, default=8001)
+    parser.add_argument("--gateway-workers", type=int, default=4)
+    parser.add_argument("--cache", action="store_true", help="保留网关的结果缓存")
+    args, loadgen_args = parser.parse_known_args()
+    if loadgen_args[:1] == ["--"]:
+        loadgen_args = loadgen_args[1:]
+
+    workdir = tempfile.mkdtemp(prefix="to_docx_bench_")
+    # 网关取任意以 _NAME 结尾的环境变量作为 WPS 后端主机名，先清除当前环境中的同类变量
+    env = {k: v for k, v in os.environ.items() if not k.endswith("_NAME")}
+    uno_ports = [args.uno_port + i for i in range(args.unoservers)]
+    gateway_env = dict(
+        env,
+        WPS_BACKEND_NAME="127.0.0.1",
+        UNO_SERVERS=",".join(f"127.0.0.1:{port}" for port in uno_ports),
+        SPOOL_DIR=workdir,
+        UNO_LOCK_DIR=os.path.join(workdir, "uno-locks"),
+        CACHE_DIR=os.path.join(workdir, "cache"),
+        QUARANTINE_DIR=os.path.join(workdir, "quarantine"),
+        JOBS_DIR=os.path.join(workdir, "jobs"),
+        ADMISSION_SOCKET=os.path.join(workdir, "admission.sock"),
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, "metrics"),
+    )
+    if not args.cache:
+        gateway_env["CACHE_MAX_BYTES"] = "0"
+    os.makedirs(gateway_env["PROMETHEUS_MULTIPROC_DIR"])
+    wps_env = dict(
+        env,
+        WPS_WORKERS=str(args.wps_workers),
+        WPS_WORKER_HOME=os.path.join(workdir, "wps-workers"),
+        QUARANTINE_DIR=os.path.join(workdir, "wps-quarantine"),
+        FAKE_WPS_STARTUP=str(args.wps_startup),
+        FAKE_WPS_OPEN=str(args.wps_open),
+        FAKE_WPS_SAVE=str(args.wps_save),
+        FAKE_WPS_PER_MB=str(args.wps_per_mb),
+        FAKE_WPS_JITTER=str(args.wps_jitter),
+    )
+
+    processes = []
+    try:
+        for port in uno_ports:
+            processes.append((port, start([
+                sys.executable, os.path.join(BENCH_DIR, "fake_unoserver.py"), "--port", str(port),
+                "--latency", str(args.uno_latency), "--jitter", str(args.uno_jitter),
+                "--per-mb", str(args.uno_per_mb),
+            ], env=env)))
+        processes.append((WPS_PORT, start(
+            [sys.executable, os.path.join(BENCH_DIR, "fake_wps_backend.py")], env=wps_env)))
+        processes.append((gateway_env["ADMISSION_SOCKET"], start(
+            [sys.executable, "mainweb.py", "broker"], cwd=REPO_DIR, env=gateway_env)))
+        processes.append((args.gateway_port, start([
+            sys.executable, "-m", "uvicorn", "mainweb:app", "--host", "127.0.0.1",
+            "--port", str(args.gateway_port), "--workers", str(args.gateway_workers), "--log-level", "warning",
+        ], cwd=REPO_DIR, env=gateway_env, stdout=subprocess.DEVNULL)))
+        for port, process in processes:
+            wait_for_port(port, process)
+
+        if not any(a.startswith("--url") for a in loadgen_args):
+            loadgen_args = ["--url", f"http://127.0.0.1:{args.gateway_port}", *loadgen_args]
+        return loadgen.main(loadgen_args)
+    finally:
+        for _, process in reversed(processes):
+            stop(process)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+网关（mainweb.py）与 WPS 后端（WPS_Server/server.py）共用的部分：请求追踪、毒文件隔离区、
+内存预算与落盘 JSON 请求体的分块解码。WPS 后端镜像的 Python 为 3.9，这里不使用更新的语法。
+"""
+import binascii
+import contextvars
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+# ------------------------------------------------------------------------------
+# 请求追踪：每个请求一个 id（取自 X-Request-ID 请求头，缺省时生成）。
+# stage() 记录的各阶段耗时同时计入当前请求，响应带 X-Request-ID 与 Server-Timing 头，
+# 请求结束后输出一行 JSON 耗时日志
+# ------------------------------------------------------------------------------
+TRACE_LOG = os.environ.get("TRACE_LOG", "1") != "0"
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+
+
+class Trace:
+    """一个请求（或异步任务）的各阶段耗时，同一阶段多次出现时累加"""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in list(self.stages.items())]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+    def log(self, **fields):
+        record = {
+            "requestId": self.request_id,
+            **fields,
+            **self.fields,
+            "durationMs": round(self.elapsed() * 1000, 1),
+            "stagesMs": {name: round(seconds * 1000, 1) for name, seconds in list(self.stages.items())},
+        }
+        print(json.dumps(record, ensure_ascii=False), flush=True)
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def request_id_from(value):
+    """沿用客户端传入的请求 id（格式不合法时忽略），否则生成新的"""
+    if value and REQUEST_ID_PATTERN.fullmatch(value):
+        return value
+    return uuid.uuid4().hex
+
+
+def current_request_id():
+    trace = current_trace.get()
+    return trace and trace.request_id
+
+
+def annotate(**fields):
+    """为当前请求的耗时日志附加字段，如源格式、目标格式、文件大小"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+def parse_server_timing(value):
+    """解析 Server-Timing 响应头，返回 [(名称, 秒)]，忽略没有 dur 的项"""
+    timings = []
+    for entry in (value or "").split(","):
+        name, *params = (part.strip() for part in entry.split(";"))
+        for param in params:
+            key, _, dur = param.partition("=")
+            if name and key == "dur":
+                try:
+                    timings.append((name, float(dur) / 1000))
+                except ValueError:
+                    pass
+    return timings
+
+
+def stage_timer(histogram):
+    """
+    返回 (observe_stage, stage)：阶段耗时计入 histogram（以阶段名为标签）与当前请求的追踪。
+    stage(name) 为记录一段代码耗时的上下文管理器
+    """
+
+    def observe_stage(name, seconds):
+        histogram.labels(name).observe(seconds)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.record(name, seconds)
+
+    @contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            observe_stage(name, time.perf_counter() - start)
+
+    return observe_stage, stage
+
+
+class TraceMiddleware:
+    """
+    ASGI 中间件：为每个 HTTP 请求建立 Trace，在响应头中加入 X-Request-ID 与 Server-Timing。
+    skip_paths 中的路径（监控轮询、就绪探测）不输出耗时日志
+    """
+
+    def __init__(self, app, skip_paths=()):
+        self.app = app
+        self.skip_paths = set(skip_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        trace = Trace(request_id_from(headers.get(b"x-request-id", b"").decode("latin-1")))
+        token = current_trace.set(trace)
+        status = 500
+
+        async def send_traced(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [
+                    *message.get("headers", []),
+                    (b"x-request-id", trace.request_id.encode()),
+                    (b"server-timing", trace.server_timing().encode()),
+                ]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            current_trace.reset(token)
+            if TRACE_LOG and scope["path"] not in self.skip_paths:
+                trace.log(event="request", method=scope["method"], path=scope["path"], status=status)
+
+
+# ------------------------------------------------------------------------------
+# 毒文件隔离区：以输入内容哈希为文件名记录隔离信息
+# ------------------------------------------------------------------------------
+def file_digest(path):
+    """输入文件内容的 sha256（按块读取），用作缓存、隔离区等的内容寻址键"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Quarantine:
+    """
+    毒文件隔离区：记录曾导致转换超时（或使转换进程崩溃）的输入内容哈希（与目标格式无关），
+    重复提交时直接拒绝，不再占用 office 进程。目录可被多个进程共享。
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+
+    def add(self, digest, reason):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, digest)
+        with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+            json.dump({"reason": reason, "time": time.time()}, f, ensure_ascii=False)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    def check(self, digest):
+        """返回隔离记录，未隔离或记录已过期时返回 None"""
+        path = os.path.join(self.directory, digest)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - entry["time"] > self.ttl:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return entry
+
+
+# ------------------------------------------------------------------------------
+# 内存预算与落盘 JSON 请求体的分块解码
+# ------------------------------------------------------------------------------
+# 落盘、复制文件时每次读写的字节数
+SPOOL_CHUNK_SIZE = 1024 * 1024
+# JSON 请求体中 fileBytes 以外的部分的大小上限
+JSON_FIELDS_MAX_BYTES = 64 * 1024
+# 分块解码时每次处理的 base64 字符数（4 的倍数）
+BASE64_DECODE_CHUNK_SIZE = 4 * 256 * 1024
+BASE64_NON_ALPHABET = re.compile(rb"[^A-Za-z0-9+/=]")
+
+
+class MemoryBudget:
+    """进程内的内存（或落盘）预算（字节），占用量同步到 gauge：预算不足时调用方改为落盘处理或拒绝请求，不等待"""
+
+    def __init__(self, limit, gauge):
+        self.limit = limit
+        self.gauge = gauge
+        self.used = 0
+        self.spooled = 0
+
+    def try_reserve(self, nbytes):
+        if self.used + nbytes > self.limit:
+            return False
+        self.used += nbytes
+        self.gauge.inc(nbytes)
+        return True
+
+    def release(self, nbytes):
+        self.used -= nbytes
+        self.gauge.dec(nbytes)
+
+    def stats(self):
+        return {"limit": self.limit, "used": self.used, "spooled": self.spooled}
+
+
+def decode_json_file_field(json_path, field, output_path):
+    """
+    从落盘的 JSON 请求体中取出 field 字段（base64 字符串），分块解码写入 output_path，
+    返回 (其余字段组成的 dict，field 为空字符串；解码后内容的哈希)。
+    找不到该字段时返回 (整个请求体解析得到的 dict, None)。
+    请求体不是合法 JSON 时抛出 json.JSONDecodeError，base64 内容或字段布局有误时抛出 ValueError
+    """
+    key = re.compile(rb'"' + re.escape(field.encode()) + rb'"\s*:\s*"')
+    with open(json_path, "rb") as src:
+        head = b""
+        while (match := key.search(head)) is None:
+            chunk = src.read(SPOOL_CHUNK_SIZE)
+            if not chunk:
+                return json.loads(head), None
+            head += chunk
+            if len(head) > JSON_FIELDS_MAX_BYTES + SPOOL_CHUNK_SIZE:
+                raise ValueError(f"{field} not found in the first {JSON_FIELDS_MAX_BYTES} bytes")
+        prefix, rest = head[:match.end() - 1], head[match.end():]
+        digest = hashlib.sha256()
+        carry = escape = b""
+        with open(output_path, "wb") as dst:
+            while True:
+                end = rest.find(b'"')
+                data = escape + (rest if end < 0 else rest[:end])
+                escape = b""
+                # 反斜杠可能与其转义的字符分在两块中
+                if end < 0 and (len(data) - len(data.rstrip(b"\\"))) % 2:
+                    data, escape = data[:-1], b"\\"
+                # JSON 编码器可能把 / 转义为 \/，或把 base64 按行折断（\n）
+                data = data.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+                data = carry + BASE64_NON_ALPHABET.sub(b"", data)
+                size = len(data) if end >= 0 else len(data) - len(data) % 4
+                carry = data[size:]
+                try:
+                    for i in range(0, size, BASE64_DECODE_CHUNK_SIZE):
+                        decoded = binascii.a2b_base64(data[i:min(i + BASE64_DECODE_CHUNK_SIZE, size)])
+                        digest.update(decoded)
+                        dst.write(decoded)
+                except binascii.Error as e:
+                    raise ValueError(f"Invalid base64 in {field}: {e}")
+                if end >= 0:
+                    suffix = rest[end + 1:] + src.read(JSON_FIELDS_MAX_BYTES)
+                    if src.read(1):
+                        raise ValueError(f"JSON fields after {field} exceed {JSON_FIELDS_MAX_BYTES} bytes")
+                    break
+                rest = src.read(SPOOL_CHUNK_SIZE)
+                if not rest:
+                    raise ValueError(f"Unterminated {field} in request body")
+    return json.loads(prefix + b'""' + suffix), digest.hexdigest()
@@ -149,20 +149,23 @@ func convertFile(index int, filePath string, wg *sync.WaitGroup) {
 		return
 	}
 	req.Header.Set("Content-Type", "application/json")
+	// 每个文档一个请求 id，服务端的耗时日志以此关联
+	requestID := fmt.Sprintf("%x-%d", time.Now().UnixNano(), index)
+	req.Header.Set("X-Request-ID", requestID)
 
 	resp, err := client.Do(req)
 	if err != nil {
 		if err, ok := err.(net.Error); ok && err.Timeout() {
-			fmt.Printf("[任务 %d] [文件 %s] 请求超时: %v\n", index,filePath, err)
+			fmt.Printf("[任务 %d] [文件 %s] [请求 %s] 请求超时: %v\n", index, filePath, requestID, err)
 		} else {
-			fmt.Printf("[任务 %d] [文件 %s] 发送请求失败: %v\n", index,filePath, err)
+			fmt.Printf("[任务 %d] [文件 %s] [请求 %s] 发送请求失败: %v\n", index, filePath, requestID, err)
 		}
 		return
 	}
 	defer resp.Body.Close()
 
 	if resp.StatusCode != http.StatusOK {
-		fmt.Printf("[任务 %d] 转换失败，HTTP状态码: %d\n", index, resp.StatusCode)
+		fmt.Printf("[任务 %d] [请求 %s] 转换失败，HTTP状态码: %d\n", index, requestID, resp.StatusCode)
 		return
 	}
 
@@ -207,7 +210,8 @@ func convertFile(index int, filePath string, wg *sync.WaitGroup) {
 		moveToBackupDir(filePath)
 	}
 
-	fmt.Printf("[任务 %d] 转换完成: %s\n", index, outputFile)
+	// Server-Timing 为服务端各阶段耗时（毫秒），wps. 开头的为 WPS 后端的阶段
+	fmt.Printf("[任务 %d] 转换完成: %s [请求 %s] 服务端耗时: %s\n", index, outputFile, requestID, resp.Header.Get("Server-Timing"))
 }
 
 // findFiles 递归查找符合扩展名的文件
@@ -1,19 +1,76 @@
 import asyncio
 import base64
+import binascii
+import contextvars
+import fcntl
+import functools
+import hashlib
+import heapq
+import http.client
+import itertools
+import json
 import logging
+import math
 import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import uuid
+import zipfile
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from importlib import metadata
-from xmlrpc.client import ServerProxy
+from typing import List, Union
+from xmlrpc.client import Fault, ServerProxy, Transport
 
 import httpx
 import uvicorn
-from fastapi import FastAPI, File, Response, UploadFile
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, File, Request, Response, UploadFile
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+from pydantic import BaseModel, ValidationError
+from starlette.background import BackgroundTask
 
-app = FastAPI()
+from docconv_common import (SPOOL_CHUNK_SIZE, TRACE_LOG, MemoryBudget, Quarantine, Trace, TraceMiddleware,
+                            annotate, current_request_id, current_trace, decode_json_file_field, file_digest,
+                            parse_server_timing, stage_timer)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global wps_client, callback_client
+    # 整个应用生命周期共用一个连接池化的 httpx 客户端访问 WPS 后端
+    wps_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(WPS_TIMEOUT, read=WPS_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=WPS_MAX_CONNECTIONS,
+            max_keepalive_connections=WPS_MAX_KEEPALIVE,
+        ),
+    )
+    # 任务完成回调使用的客户端
+    callback_client = httpx.AsyncClient(timeout=10)
+    threading.Thread(target=uno_balancer.monitor, daemon=True).start()
+    monitor_task = asyncio.create_task(monitor_wps_backends())
+    job_tasks = job_queue.start()
+    try:
+        yield
+    finally:
+        monitor_task.cancel()
+        await job_queue.stop(job_tasks)
+        await wps_client.aclose()
+        await callback_client.aclose()
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            multiprocess.mark_process_dead(os.getpid())
+
+app = FastAPI(lifespan=lifespan)
 
 # 自动获取docker cli的--link 值
 wps_api_host = None
@@ -25,19 +82,159 @@ for key, value in os.environ.items():
 class ConvertRequest(BaseModel):
     fileBytes: str   # Base64 编码的二进制数据
     sourceType: str
-    targetType: str  # 例如 "pdf"
+    targetType: Union[str, List[str]]  # 例如 "pdf"，也可以是多个格式：["docx", "pdf"] 或 "docx,pdf"
+
+
+class ConversionError(Exception):
+    """转换失败；status_code 为流式接口返回给客户端的 HTTP 状态码，headers 为附加的响应头"""
+
+    def __init__(self, message, status_code=500, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers
+
+
+class DeadlineExceeded(ConversionError):
+    """
+    转换超过截止时间。exclusive 表示超时的转换独占了该 office 实例，超时可归咎于文档本身
+    （此时才隔离文档、重启实例）；无法确认独占时（如可能被其他主机共用的远程实例）为 False
+    """
+
+    def __init__(self, message, exclusive=True):
+        super().__init__(message, 504)
+        self.exclusive = exclusive
+
+
+class BackendCrashed(ConversionError):
+    """
+    请求送达后 office 实例断开了连接（通常是文档使其崩溃）。exclusive 的含义与 DeadlineExceeded 相同：
+    独占实例时才归咎于文档并隔离
+    """
+
+    def __init__(self, message, exclusive=True):
+        super().__init__(message, 502)
+        self.exclusive = exclusive
 
 
-# 创建线程池
+def blames_document(error):
+    """转换失败可归咎于文档本身（独占实例时超时或使实例崩溃），应隔离该文档"""
+    return isinstance(error, (DeadlineExceeded, BackendCrashed)) and error.exclusive
+
+
+class Overloaded(ConversionError):
+    """后端名额的（预计）等待时间超过预算，客户端应在 retry_after 秒后重试"""
+
+    def __init__(self, backend, retry_after):
+        super().__init__(f"{backend} backend is busy, retry after {retry_after:.0f}s", 429,
+                         {"Retry-After": str(max(math.ceil(retry_after), 1))})
+        self.retry_after = retry_after
+
+
+# ------------------------------------------------------------------------------
+# Prometheus 指标。多个 uvicorn worker 时需设置 PROMETHEUS_MULTIPROC_DIR（见 supervisord.conf），
+# /metrics 汇总所有 worker 的数据
+# ------------------------------------------------------------------------------
+STAGE_SECONDS = Histogram(
+    "docconv_stage_seconds", "各处理阶段耗时", ["stage"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+CONVERSIONS = Counter(
+    "docconv_conversions_total", "转换次数（按源格式、目标格式、后端、结果）",
+    ["source", "target", "backend", "result"],
+)
+EXECUTOR_QUEUE = Gauge("docconv_executor_queue_depth", "等待转换线程池的任务数", multiprocess_mode="livesum")
+ADMISSION_WAITING = Gauge("docconv_admission_waiters", "等待后端并发名额的请求数", ["backend"],
+                          multiprocess_mode="livesum")
+ADMISSION_REJECTED = Counter("docconv_admission_rejected_total", "等待超过预算而被拒绝（429）的请求数", ["backend"])
+JOB_QUEUE_DEPTH = Gauge("docconv_job_queue_depth", "异步任务队列中排队的任务数", multiprocess_mode="livesum")
+UNOSERVER_RESTARTS = Counter("docconv_unoserver_restarts_total", "因超时重启 unoserver 的次数")
+PREVIEWS = Counter("docconv_previews_total", "预览次数（按源格式、预览格式、结果）", ["source", "format", "result"])
+SOURCE_MISMATCHES = Counter("docconv_source_mismatches_total", "文件内容与声明的源格式不符的次数",
+                            ["claimed", "detected"])
+MEMORY_RESERVED = Gauge("docconv_memory_reserved_bytes", "整块读入内存处理的请求体占用的内存预算",
+                        multiprocess_mode="livesum")
+SPOOL_RESERVED = Gauge("docconv_spool_reserved_bytes", "落盘处理的请求体占用的落盘预算",
+                       multiprocess_mode="livesum")
+SPOOLED_BODIES = Counter("docconv_spooled_bodies_total", "落盘后分块解码的 JSON 请求体数")
+WPS_BACKEND_EJECTIONS = Counter("docconv_wps_backend_ejections_total", "WPS 后端因连续失败被暂停分配的次数",
+                                ["backend"])
+
+
+# ------------------------------------------------------------------------------
+# 请求追踪（见 docconv_common，与 WPS 后端共用）：请求 id 随请求转发给 WPS 后端，
+# WPS 后端返回的 Server-Timing 以 wps. 前缀并入网关的 Server-Timing
+# ------------------------------------------------------------------------------
+observe_stage, stage = stage_timer(STAGE_SECONDS)
+# 不输出耗时日志的路径（监控轮询）
+app.add_middleware(TraceMiddleware, skip_paths={"/metrics"})
+
+
+# 创建线程池；大文件使用单独的线程池，远程 unoserver 上的大文件转换不会占满小文件的线程
 executor = ThreadPoolExecutor(max_workers=4)
+large_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("LARGE_EXECUTOR_WORKERS", "2")))
+
+
+async def run_in_executor(fn, *args, lane="small"):
+    """在转换线程池（lane 为 large 时为大文件线程池）中执行 fn，并记录排队等待时间"""
+    submitted = time.perf_counter()
+    EXECUTOR_QUEUE.inc()
+
+    def run():
+        EXECUTOR_QUEUE.dec()
+        observe_stage("executor_wait", time.perf_counter() - submitted)
+        return fn(*args)
+
+    pool = large_executor if lane == "large" else executor
+    # 在线程中沿用当前请求的追踪上下文
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(pool, context.run, run)
+
+
 API_VERSION = "3"
 __version__ = metadata.version("unoserver")
 logger = logging.getLogger("unoserver")
 
+# unoserver 握手信息（API 版本、过滤器列表）的缓存时间（秒）
+UNO_INFO_TTL = float(os.environ.get("UNO_INFO_TTL", "300"))
+
+
+class DeadlineTransport(Transport):
+    """可随时调整 socket 超时的 XML-RPC Transport，timeout 为 None 时不超时"""
+
+    timeout = None
+
+    def request(self, host, handler, request_body, verbose=False):
+        # 不像 Transport 那样在连接被重置时自动重发：转换请求可能已送达并使实例崩溃，
+        # 重发会把同一文档再交给实例，也无法再区分“未送达”与“送达后断开”
+        return self.single_request(host, handler, request_body, verbose)
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self.timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(self.timeout)
+        return conn
+
+
 class UnoClient:
-    def __init__(self, server="127.0.0.1", port="2003", host_location="auto"):
+    def __init__(self, server="127.0.0.1", port="2003", host_location="auto", connect_retries=5,
+                 supervisor_name=None, lock_dir=None, poll_interval=0.05):
         self.server = server
         self.port = port
+        self.connect_retries = connect_retries
+        # supervisord 中对应的进程名，用于超时后重启；远程实例为 None
+        self.supervisor_name = supervisor_name
+        # 实例的文件锁（flock），所有 worker 共享，保证实例同时只进行一个转换；None 时不加锁
+        self.lock_path = None
+        if lock_dir is not None:
+            os.makedirs(lock_dir, exist_ok=True)
+            self.lock_path = os.path.join(lock_dir, f"{server}_{port}.lock")
+        self.poll_interval = poll_interval
+        # 每个线程复用各自的 ServerProxy（ServerProxy 不是线程安全的）
+        self._local = threading.local()
+        self._info = None
+        self._info_time = 0
+        self._info_lock = threading.Lock()
         if host_location == "auto":
             if server in ("127.0.0.1", "localhost"):
                 self.remote = False
@@ -69,6 +266,60 @@ class UnoClient:
                 else:
                     raise
 
+    def _proxy(self):
+        proxy = getattr(self._local, "proxy", None)
+        if proxy is None:
+            self._local.transport = DeadlineTransport()
+            proxy = ServerProxy(f"http://{self.server}:{self.port}",
+                                transport=self._local.transport, allow_none=True)
+            self._local.proxy = proxy
+        return proxy
+
+    def reset(self):
+        """丢弃当前线程的连接和缓存的握手信息，下次调用时重新连接"""
+        proxy = getattr(self._local, "proxy", None)
+        if proxy is not None:
+            proxy("close")()
+            self._local.proxy = None
+        self._info = None
+
+    def info(self):
+        """返回 unoserver 的握手信息，在 UNO_INFO_TTL 内复用缓存的结果"""
+        with self._info_lock:
+            now = time.monotonic()
+            if self._info is None or now - self._info_time > UNO_INFO_TTL:
+                logger.info("Connecting.")
+                logger.debug(f"Host: {self.server} Port: {self.port}")
+                self._info = self._connect(self._proxy(), retries=self.connect_retries)
+                self._info_time = now
+            return self._info
+
+    def ping(self, timeout):
+        """重新连接并握手，检查实例是否可用；timeout 秒内无响应时抛出 TimeoutError"""
+        self.reset()
+        self._proxy()
+        self._local.transport.timeout = timeout
+        self.info()
+
+    def try_hold(self):
+        """非阻塞地占用实例，成功时返回持有锁的文件描述符，实例繁忙时返回 None"""
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def hold(self):
+        """占用实例，实例繁忙时等待，返回持有锁的文件描述符"""
+        with stage("unoserver_wait"):
+            while True:
+                fd = self.try_hold()
+                if fd is not None:
+                    return fd
+                time.sleep(self.poll_interval)
+
     def convert(
         self,
         inpath=None,
@@ -79,7 +330,13 @@ class UnoClient:
         filter_options=[],
         update_index=True,
         infiltername=None,
+        timeout=None,
+        held=False,
     ):
+        """
+        timeout 为转换的截止时间（秒），超时后抛出 DeadlineExceeded。截止时间从占用实例后
+        才开始计算，排在同一实例上其他转换之后的等待不计入；held 表示调用方已占用实例
+        """
         if inpath is None and indata is None:
             raise RuntimeError("Nothing to convert.")
 
@@ -94,10 +351,27 @@ class UnoClient:
             else:
                 convert_to = os.path.splitext(outpath)[-1].strip(os.path.extsep)
 
-        with ServerProxy(f"http://{self.server}:{self.port}", allow_none=True) as proxy:
-            logger.info("Connecting.")
-            logger.debug(f"Host: {self.server} Port: {self.port}")
-            info = self._connect(proxy)
+        if inpath:
+            if self.remote:
+                # 远程实例无法访问本机文件，改为发送文件内容
+                with open(inpath, "rb") as infile:
+                    indata = infile.read()
+                    inpath = None
+            else:
+                inpath = os.path.abspath(inpath)
+
+        fd = None
+        if not held and self.lock_path is not None:
+            fd = self.hold()
+        # 占用了本机实例时，超时的转换必定是该实例上唯一的转换
+        exclusive = self.lock_path is not None and not self.remote
+        try:
+            proxy = self._proxy()
+            self._local.transport.timeout = timeout
+            try:
+                info = self.info()
+            except TimeoutError as e:
+                raise ConnectionError(f"unoserver {self.server}:{self.port} is not responding") from e
 
             if infiltername and infiltername not in info["import_filters"]:
                 existing = "\n".join(sorted(info["import_filters"]))
@@ -114,16 +388,35 @@ class UnoClient:
                 raise RuntimeError("Invalid parameter")
 
             logger.info("Converting.")
-            result = proxy.convert(
-                inpath,
-                indata,
-                None if self.remote else outpath,
-                convert_to,
-                filtername,
-                filter_options,
-                update_index,
-                infiltername,
-            )
+            try:
+                result = proxy.convert(
+                    inpath,
+                    indata,
+                    None if self.remote else outpath,
+                    convert_to,
+                    filtername,
+                    filter_options,
+                    update_index,
+                    infiltername,
+                )
+            except TimeoutError:
+                self.reset()
+                raise DeadlineExceeded(f"Conversion exceeded the {timeout:g}s deadline", exclusive)
+            except ConnectionRefusedError:
+                # 请求未送达，调用方可以换一个实例重试
+                self.reset()
+                raise
+            except (ConnectionError, http.client.HTTPException) as e:
+                self.reset()
+                raise BackendCrashed(
+                    f"unoserver {self.server}:{self.port} dropped the connection during conversion: {e!r}",
+                    exclusive) from e
+            except Fault as e:
+                # unoserver 自身的 --conversion-timeout 触发时以 Fault 形式返回
+                if "TimeoutError" in e.faultString:
+                    self.reset()
+                    raise DeadlineExceeded("Conversion exceeded unoserver's conversion timeout", exclusive)
+                raise
             if result is not None:
                 # We got the file back over xmlrpc:
                 if outpath:
@@ -136,96 +429,2460 @@ class UnoClient:
                     return result.data
             else:
                 logger.info(f"Saved to {outpath}.")
+        except ConnectionError:
+            self.reset()
+            raise
+        finally:
+            if fd is not None:
+                os.close(fd)
 
-client = UnoClient(server="127.0.0.1", port = 2003)
-def sync_convert(infileData:bytes=None,convert_to:str="docx"):
-    result = client.convert(
-        inpath=None,
-        indata=infileData,
-        outpath=None,
-        convert_to=convert_to,
-        filtername=None,
-        filter_options=[],
-        update_index=True,
-        infiltername=None,
-    )
-    return result
+class UnoBalancer:
+    """
+    在多个 unoserver 实例之间分配转换。每个实例同时只进行一个转换：各 uvicorn worker 通过
+    实例的文件锁（UnoClient.lock_path）互斥，转换前占用一个空闲实例，全部繁忙时等待。
+    连接失败的实例被移出可用列表，由后台探测在其恢复后重新加入。
+    """
 
+    def __init__(self, clients, probe_interval=10, poll_interval=0.05, probe_timeout=5):
+        """
+        :param clients: UnoClient 列表，需设置 lock_dir
+        :param probe_interval: 探测已失效实例的间隔（秒）
+        :param poll_interval: 全部实例繁忙时重试的间隔（秒）
+        :param probe_timeout: 探测单个实例的超时（秒），卡死的实例不会阻塞对其他实例的探测
+        """
+        self.clients = clients
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.poll_interval = poll_interval
+        self.busy = {c: 0 for c in clients}
+        self.dead = set()
+        self.lock = threading.Lock()
+        # 各 worker 从不同的实例开始尝试，避免都先占用第一个实例
+        self.rotation = itertools.count(os.getpid())
 
+    def acquire(self, exclude=()):
+        """占用一个空闲的存活实例，返回 (实例, 锁文件描述符)；全部繁忙时等待"""
+        with stage("unoserver_wait"):
+            while True:
+                with self.lock:
+                    candidates = [c for c in self.clients if c not in self.dead and c not in exclude]
+                    if not candidates:
+                        raise RuntimeError("No live unoserver instance available")
+                    start = next(self.rotation) % len(candidates)
+                    candidates = candidates[start:] + candidates[:start]
+                for client in candidates:
+                    fd = client.try_hold()
+                    if fd is not None:
+                        with self.lock:
+                            self.busy[client] += 1
+                        return client, fd
+                time.sleep(self.poll_interval)
 
+    def release(self, client, fd, dead=False):
+        with self.lock:
+            self.busy[client] -= 1
+            if dead and client not in self.dead:
+                print(f"unoserver {client.server}:{client.port} 不可用，暂停分配")
+                self.dead.add(client)
+        os.close(fd)
 
-async def convert_via_wps_backend(filebytes: str, source_type: str, target_type: str):
-    url = f"http://{wps_api_host}:8000/convert"  # 使用 Docker 内部网络
-    request_data = {
-        "fileBytes": filebytes,
-        "sourceType": source_type,
-        "targetType": target_type
-    }
+    def convert(self, **kwargs):
+        """
+        选择一个实例执行 UnoClient.convert；请求未送达（连接失败）时换下一个实例重试。
+        送达后实例断开连接（BackendCrashed）不重试，否则一个使实例崩溃的文档会依次弄垮所有实例
+        """
+        tried = []
+        while True:
+            client, fd = self.acquire(exclude=tried)
+            try:
+                result = client.convert(held=True, **kwargs)
+            except ConnectionError:
+                self.release(client, fd, dead=True)
+                tried.append(client)
+                continue
+            except BackendCrashed:
+                # 实例进程由 supervisord 拉起，恢复后由探测重新加入
+                self.release(client, fd, dead=True)
+                raise
+            except DeadlineExceeded as e:
+                # 独占实例时超时，说明实例已卡死：暂停分配并重启，恢复后由探测重新加入
+                self.release(client, fd, dead=e.exclusive)
+                if e.exclusive:
+                    threading.Thread(target=self.restart, args=(client,), daemon=True).start()
+                raise
+            except BaseException:
+                self.release(client, fd)
+                raise
+            self.release(client, fd)
+            return result
 
-    # 设置超时时间为 60 秒（或根据实际情况调整）
-    timeout = httpx.Timeout(100.0, read=100.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        response = await client.post(url, json=request_data)
+    def restart(self, client):
+        """通过 supervisorctl 重启本机的 unoserver 实例（连同其 LibreOffice 进程）"""
+        if client.supervisor_name is None:
+            return
+        print(f"重启 unoserver {client.supervisor_name}")
+        UNOSERVER_RESTARTS.inc()
+        try:
+            subprocess.run(
+                ["supervisorctl", "-c", SUPERVISOR_CONF,
+                 "-u", "admin", "-p", os.environ.get("UNIX_HTTP_SERVER_PASSWORD", ""),
+                 "restart", client.supervisor_name],
+                capture_output=True, timeout=60,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"重启 unoserver {client.supervisor_name} 失败：", e)
 
-    if response.status_code == 200:
-        data = response.json()
-        if data.get("status") == "ok":
-            decoded_file = base64.b64decode(data["fileBytes"])
-            # print("wps后台正常返回", type(decoded_file))
-            return {"status": "ok", "data": decoded_file}
-        else:
-            # 返回错误信息而非直接抛出异常
-            return {"status": "error", "message": data.get("message", "未知错误")}
-    else:
-        return {"status": "error", "message": response.text or "未知错误"}
+    def probe(self):
+        """重新探测已失效的实例，恢复的实例重新参与分配"""
+        with self.lock:
+            dead = list(self.dead)
+        for client in dead:
+            try:
+                client.ping(self.probe_timeout)
+            except Exception:
+                continue
+            with self.lock:
+                self.dead.discard(client)
+            print(f"unoserver {client.server}:{client.port} 已恢复")
+
+    def monitor(self):
+        while True:
+            time.sleep(self.probe_interval)
+            self.probe()
+
+    def stats(self):
+        with self.lock:
+            return [
+                {"server": f"{c.server}:{c.port}", "busy": self.busy[c], "alive": c not in self.dead}
+                for c in self.clients
+            ]
+
+
+def parse_endpoints(value):
+    """解析 "host:port,host:port" 形式的地址列表"""
+    endpoints = []
+    for item in value.split(","):
+        item = item.strip()
+        if item:
+            host, _, port = item.rpartition(":")
+            endpoints.append((host, int(port)))
+    return endpoints
+
+
+# unoserver 实例列表，默认对应 supervisord.conf 中启动的 2003..2006 四个实例
+UNO_SERVERS = parse_endpoints(os.environ.get(
+    "UNO_SERVERS", "127.0.0.1:2003,127.0.0.1:2004,127.0.0.1:2005,127.0.0.1:2006"))
+# supervisord 配置文件（由 entrypoint.sh 导出）与 unoserver 的程序名；
+# 本机端口 200N 的实例对应进程 unoserver:unoserver_N
+SUPERVISOR_CONF = os.environ.get("SUPERVISOR_INTERACTIVE_CONF", "/supervisor/conf/interactive/supervisord.conf")
+UNO_SUPERVISOR_PROGRAM = os.environ.get("UNO_SUPERVISOR_PROGRAM", "unoserver")
+
+
+def supervisor_name(host, port):
+    if host not in ("127.0.0.1", "localhost"):
+        return None
+    return f"{UNO_SUPERVISOR_PROGRAM}:{UNO_SUPERVISOR_PROGRAM}_{port - 2000}"
+
+
+uno_balancer = UnoBalancer(
+    [UnoClient(server=host, port=port, connect_retries=1, supervisor_name=supervisor_name(host, port),
+               lock_dir=os.environ.get("UNO_LOCK_DIR", "/tmp/to_docx_uno_locks"))
+     for host, port in UNO_SERVERS],
+    probe_interval=float(os.environ.get("UNO_PROBE_INTERVAL", "10")),
+    probe_timeout=float(os.environ.get("UNO_PROBE_TIMEOUT", "5")),
+)
+
+# 转换截止时间（秒）及按源格式的覆盖值（如 "xls=120,ppt=90"）
+CONVERSION_DEADLINE = float(os.environ.get("CONVERSION_DEADLINE", "60"))
+CONVERSION_DEADLINES = {
+    fmt.strip(): float(seconds)
+    for fmt, _, seconds in (item.partition("=") for item in os.environ.get("CONVERSION_DEADLINES", "").split(",") if item)
+}
+
+
+def deadline_for(source_type):
+    return CONVERSION_DEADLINES.get(source_type, CONVERSION_DEADLINE)
+
+
+def sync_convert_file(input_path: str, convert_to: str, output_path: str, deadline: float = None,
+                      filter_options=()):
+    """
+    按路径转换：本机 unoserver 直接读写落盘文件，文件内容不经 XML-RPC 传输；
+    远程实例由 UnoClient 读取文件后发送，结果写入 output_path。
+    filter_options 为 "名称=值" 形式的导出过滤器参数（FilterData），如 "PageRange=1-3"
+    """
+    with stage("uno_convert"):
+        uno_balancer.convert(
+            inpath=input_path,
+            indata=None,
+            outpath=output_path,
+            convert_to=convert_to,
+            filtername=None,
+            filter_options=list(filter_options),
+            update_index=True,
+            infiltername=None,
+            timeout=deadline,
+        )
+
+
+def content_digest(data: bytes) -> str:
+    """输入文件内容的 sha256，用作缓存等的内容寻址键"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """
+    以内容寻址的转换结果磁盘缓存。
+
+    键为 hash(输入内容, 源格式, 目标格式, 过滤参数)，值为转换结果文件。
+    文件的 mtime 记录写入时间（用于 TTL），atime 记录最近访问时间（用于 LRU 淘汰），
+    两者都由缓存显式设置，不依赖文件系统的 atime 挂载选项。
+    缓存目录可被多个 uvicorn worker 共享，命中/未命中计数为进程内统计。
+    """
+
+    def __init__(self, directory, max_bytes, ttl, rescan_interval=60):
+        """
+        :param directory: 缓存目录
+        :param max_bytes: 缓存总大小上限（字节），为 0 时禁用缓存
+        :param ttl: 缓存有效期（秒）
+        :param rescan_interval: 重新统计目录大小的间隔（秒），用于感知其他 worker 的写入
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.rescan_interval = rescan_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self._size = None
+        self._last_scan = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(digest, source_type, target_type, filter_options=()):
+        params = json.dumps([source_type, target_type, list(filter_options)])
+        return hashlib.sha256(f"{digest}:{params}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get_file(self, key, output_path):
+        """命中时将缓存的结果复制到 output_path 并返回 True，未命中或已过期时返回 False"""
+        if not self.enabled:
+            return False
+        path = self._path(key)
+        now = time.time()
+        try:
+            st = os.stat(path)
+            if now - st.st_mtime > self.ttl:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            shutil.copyfile(path, output_path)
+            os.utime(path, (now, st.st_mtime))
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def put_file(self, key, result_path):
+        size = os.path.getsize(result_path)
+        if not self.enabled or size > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(result_path, tmp_path)
+        now = time.time()
+        os.utime(tmp_path, (now, now))
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self._size is not None:
+                self._size += size
+            need_scan = (self._size is None or self._size > self.max_bytes
+                         or now - self._last_scan > self.rescan_interval)
+        if need_scan:
+            self._evict()
+
+    def _evict(self):
+        """删除过期条目，并按最近访问时间淘汰，直到总大小不超过上限"""
+        now = time.time()
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith((".tmp", ".lock")):
+                    continue
+                entries.append((st.st_atime, st.st_mtime, st.st_size, path))
+        total = sum(e[2] for e in entries)
+        evicted = 0
+        for atime, mtime, size, path in sorted(entries):
+            if total <= self.max_bytes and now - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with self.lock:
+            self._size = total
+            self._last_scan = now
+            self.evictions += evicted
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+            }
+
+
+result_cache = ResultCache(
+    directory=os.environ.get("CACHE_DIR", "/tmp/to_docx_cache"),
+    max_bytes=int(os.environ.get("CACHE_MAX_BYTES", str(1024 ** 3))),
+    ttl=float(os.environ.get("CACHE_TTL", str(7 * 24 * 3600))),
+)
+
+
+class SingleFlight:
+    """
+    合并同时进行的相同转换（键与结果缓存相同）。
+    同一 worker 内，后来者等待先来者的转换完成，由先来者把结果复制给它们；
+    不同 worker 之间，先来者持有缓存目录中 {key}.lock 的文件锁（flock），
+    其他 worker 等锁释放后从结果缓存读取，因此跨 worker 的合并需要启用缓存。
+    """
+
+    def __init__(self, directory, poll_interval=0.05):
+        """
+        :param directory: 锁文件所在目录（即缓存目录）
+        :param poll_interval: 等待其他 worker 释放锁时的轮询间隔（秒）
+        """
+        self.directory = directory
+        self.poll_interval = poll_interval
+        # 键 => (Future, 等待者的结果文件路径列表)，只在事件循环中访问
+        self.flights = {}
+        self.coalesced = 0
+
+    def join(self, key, output_path):
+        """已有相同的转换在进行时登记为等待者并返回其 Future，否则登记为先来者并返回 None"""
+        flight = self.flights.get(key)
+        if flight is not None:
+            flight[1].append(output_path)
+            self.coalesced += 1
+            return flight[0]
+        self.flights[key] = (asyncio.get_running_loop().create_future(), [])
+        return None
+
+    async def wait(self, key, future, output_path):
+        """
+        等待先来者结束，返回其异常（成功时为 None）。不设等待上限：先来者的排队与转换
+        已分别受准入等待上限和转换截止时间约束，等待者无需再限时
+        """
+        try:
+            return await asyncio.shield(future)
+        except BaseException:
+            # 不再等待时退出登记，避免先来者向已删除的路径写入结果
+            flight = self.flights.get(key)
+            if flight is not None and flight[0] is future and output_path in flight[1]:
+                flight[1].remove(output_path)
+            raise
+
+    def finish(self, key, result_path, error=None):
+        """先来者结束转换：成功时把结果复制给各等待者，失败时把异常交给它们"""
+        future, followers = self.flights.pop(key)
+        if error is None:
+            try:
+                for path in followers:
+                    shutil.copyfile(result_path, path)
+            except OSError as e:
+                error = ConversionError(f"Failed to share the conversion result: {e}")
+        future.set_result(error)
+
+    def _lock_path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.lock")
+
+    def _try_lock(self, key):
+        path = self._lock_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            # 拿到的是上一个持有者已删除的锁文件，重新创建
+            os.close(fd)
+
+    async def lock(self, key):
+        """获取跨 worker 的文件锁，被其他 worker 持有时等待其释放（同样不设等待上限，见 wait）"""
+        while (fd := self._try_lock(key)) is None:
+            await asyncio.sleep(self.poll_interval)
+        return fd
+
+    def unlock(self, key, fd):
+        # 先删除再解锁：正在等待旧锁文件的 worker 拿到锁后会发现它已被删除
+        try:
+            os.remove(self._lock_path(key))
+        except FileNotFoundError:
+            pass
+        os.close(fd)
 
-@app.post("/convert")
-async def convert_file(request: ConvertRequest):
+    def stats(self):
+        return {"inFlight": len(self.flights), "coalesced": self.coalesced}
+
+
+single_flight = SingleFlight(result_cache.directory)
+
+# 毒文件隔离区（见 docconv_common），目录可被多个 worker 共享
+quarantine = Quarantine(
+    directory=os.environ.get("QUARANTINE_DIR", "/tmp/to_docx_quarantine"),
+    ttl=float(os.environ.get("QUARANTINE_TTL", str(7 * 24 * 3600))),
+)
+
+
+# 共享内存不小于该值时才将其作为默认落盘目录（Docker 默认的 /dev/shm 只有 64MB）
+SPOOL_SHM_MIN_BYTES = 512 * 1024 * 1024
+
+
+def default_spool_dir():
+    """优先使用 tmpfs：本机 unoserver 按路径读写落盘文件，避免磁盘 IO"""
+    try:
+        st = os.statvfs("/dev/shm")
+    except OSError:
+        return tempfile.gettempdir()
+    if st.f_blocks * st.f_frsize < SPOOL_SHM_MIN_BYTES:
+        return tempfile.gettempdir()
+    return "/dev/shm/to_docx_spool"
+
+
+# 上传文件与转换结果的落盘目录，需可被本机 unoserver 访问
+SPOOL_DIR = os.environ.get("SPOOL_DIR") or default_spool_dir()
+os.makedirs(SPOOL_DIR, exist_ok=True)
+
+
+# 只由网关自己读写的大文件（如落盘的 JSON 请求体）所在的目录，应位于磁盘而非 tmpfs
+DISK_SPOOL_DIR = os.environ.get("DISK_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "to_docx_disk_spool")
+os.makedirs(DISK_SPOOL_DIR, exist_ok=True)
+
+
+def new_spool_path(suffix, directory=SPOOL_DIR):
+    fd, path = tempfile.mkstemp(suffix=f".{suffix}", dir=directory)
+    os.close(fd)
+    return path
+
+
+def new_disk_spool_path(suffix):
+    return new_spool_path(suffix, DISK_SPOOL_DIR)
+
+
+def remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def check_spool_size(size, max_bytes):
+    if max_bytes is not None and size > max_bytes:
+        raise ConversionError(f"Upload exceeds {max_bytes} bytes", 413)
+
+
+async def spool_stream(upload, suffix: str, directory: str = SPOOL_DIR, max_bytes: int = None):
+    """将上传的文件（UploadFile）分块写入落盘文件，返回 (文件路径, 哈希)；超过 max_bytes 时抛出 413"""
+    path = new_spool_path(suffix, directory)
+    digest = hashlib.sha256()
+    try:
+        with stage("upload"), open(path, "wb") as f:
+            while chunk := await upload.read(SPOOL_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+                check_spool_size(f.tell(), max_bytes)
+    except BaseException:
+        remove_files(path)
+        raise
+    return path, digest.hexdigest()
+
+
+async def spool_upload(request: Request, suffix: str, directory: str = SPOOL_DIR, max_bytes: int = None):
+    """
+    将请求体边接收边写入落盘文件，同时计算内容哈希，返回 (文件路径, 哈希)。
+    请求体可以是原始文件内容，也可以是带 file 字段的 multipart 表单。超过 max_bytes 时抛出 413
+    """
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise ConversionError("multipart 请求缺少 file 字段", 400)
+        return await spool_stream(upload, suffix, directory, max_bytes)
+
+    path = new_spool_path(suffix, directory)
+    digest = hashlib.sha256()
+    try:
+        with stage("upload"), open(path, "wb") as f:
+            async for chunk in request.stream():
+                digest.update(chunk)
+                f.write(chunk)
+                check_spool_size(f.tell(), max_bytes)
+    except BaseException:
+        remove_files(path)
+        raise
+    return path, digest.hexdigest()
+
+
+async def aiter_file(path):
+    with open(path, "rb") as f:
+        while chunk := f.read(SPOOL_CHUNK_SIZE):
+            yield chunk
+
+
+# ------------------------------------------------------------------------------
+# 内存预算与大小文件通道。
+# JSON 接口的请求体（base64）不超过阈值且进程内存预算有余量时整块读入内存解码，
+# 否则边接收边落盘、再分块解码 fileBytes，内存占用与文件大小无关。
+# 不小于 LARGE_FILE_BYTES 的文件走大文件通道：各后端另有大文件并发上限，并使用单独的线程池，
+# 少数超大文档不会占满后端名额而饿死对延迟敏感的小文档
+# ------------------------------------------------------------------------------
+SPOOL_MEMORY_THRESHOLD = int(os.environ.get("SPOOL_MEMORY_THRESHOLD", str(8 * 1024 ** 2)))
+MEMORY_BUDGET = int(os.environ.get("MEMORY_BUDGET", str(256 * 1024 ** 2)))
+# 每个 worker 同时落盘处理的 JSON 请求体（请求体及解码后的文件）的总字节数上限
+SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_BYTES", str(2 * 1024 ** 3)))
+LARGE_FILE_BYTES = int(os.environ.get("LARGE_FILE_BYTES", str(20 * 1024 ** 2)))
+
+memory_budget = MemoryBudget(MEMORY_BUDGET, MEMORY_RESERVED)
+spool_budget = MemoryBudget(SPOOL_MAX_BYTES, SPOOL_RESERVED)
+
+
+def file_lane(path):
+    return "large" if os.path.getsize(path) >= LARGE_FILE_BYTES else "small"
+
+
+def json_body(model):
+    """JSON 接口不再由 FastAPI 解析请求体，openapi_extra 保留文档中的请求体结构"""
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": model.model_json_schema()}}}}
+
+
+def body_validation_error(e: ValidationError):
+    """与 FastAPI 自行解析请求体时的 422 响应保持一致，loc 以 body 开头"""
+    return RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors()])
+
+
+async def spool_json_request(request: Request, model):
+    """
+    读取 JSON 请求体（fileBytes 为 base64 编码的文件内容），将文件内容写入落盘文件，
+    返回 (请求对象，其 fileBytes 已清空；文件路径；哈希)。请求体不符合 model 时抛出 RequestValidationError
+    """
+    length = int(request.headers.get("content-length") or 0)
+    # 请求体、解析出的 base64 字符串与解码后的内容同时在内存中，约为请求体的 3 倍
+    reserved = 3 * length
+    if 0 < length <= SPOOL_MEMORY_THRESHOLD and memory_budget.try_reserve(reserved):
+        try:
+            with stage("upload"):
+                body = await request.body()
+            with stage("decode"):
+                try:
+                    parsed = model.model_validate_json(body)
+                except ValidationError as e:
+                    raise body_validation_error(e)
+                try:
+                    data = base64.b64decode(parsed.fileBytes)
+                except binascii.Error as e:
+                    raise ConversionError(f"Invalid base64 in fileBytes: {e}", 422)
+            parsed.fileBytes = ""
+            input_path = new_spool_path(parsed.sourceType)
+            with open(input_path, "wb") as f:
+                f.write(data)
+            return parsed, input_path, content_digest(data)
+        finally:
+            memory_budget.release(reserved)
+
+    # 请求体只由网关读取，落盘到磁盘；解码后的文件需被本机 unoserver 读取，写入 SPOOL_DIR。
+    # 两者合计按请求体的 2 倍计入落盘预算，未声明长度的请求体边接收边追加
+    def reserve(nbytes):
+        if nbytes > spool_budget.limit:
+            raise ConversionError(f"Request body exceeds {spool_budget.limit // 2} bytes", 413)
+        if not spool_budget.try_reserve(nbytes):
+            raise ConversionError("Too many large request bodies are being processed, please retry later", 503)
+        return nbytes
+
+    memory_budget.spooled += 1
+    SPOOLED_BODIES.inc()
+    body_path = new_disk_spool_path("json")
+    # tmpfs 剩余空间（所有 worker 共用）不足时，解码后的文件也放在磁盘上
+    st = os.statvfs(SPOOL_DIR)
+    data_dir = SPOOL_DIR if st.f_bavail * st.f_frsize >= length else DISK_SPOOL_DIR
+    data_path = new_spool_path("upload", data_dir)
+    reserved = 0
+    try:
+        reserved = reserve(2 * length)
+        with stage("upload"), open(body_path, "wb") as f:
+            received = 0
+            async for chunk in request.stream():
+                received += len(chunk)
+                if 2 * received > reserved:
+                    reserved += reserve(2 * received - reserved)
+                f.write(chunk)
+        with stage("decode"):
+            try:
+                fields, digest = await asyncio.to_thread(decode_json_file_field, body_path, "fileBytes", data_path)
+            except json.JSONDecodeError as e:
+                raise RequestValidationError([{"type": "json_invalid", "loc": ("body",), "msg": f"{e}"}])
+            except ValueError as e:
+                raise ConversionError(str(e), 422)
+            try:
+                parsed = model.model_validate(fields)
+            except ValidationError as e:
+                raise body_validation_error(e)
+        input_path = new_spool_path(parsed.sourceType, data_dir)
+        os.replace(data_path, input_path)
+        return parsed, input_path, digest
+    finally:
+        remove_files(body_path, data_path)
+        spool_budget.release(reserved)
+
+
+# WPS 后端请求超时（秒）
+WPS_TIMEOUT = float(os.environ.get("WPS_TIMEOUT", "100"))
+# 连接池上限：最大连接数 / 最大保持活动的空闲连接数
+WPS_MAX_CONNECTIONS = int(os.environ.get("WPS_MAX_CONNECTIONS", "20"))
+WPS_MAX_KEEPALIVE = int(os.environ.get("WPS_MAX_KEEPALIVE", "10"))
+# 同时发往每个 WPS 后端的转换数（所有网关 worker 合计），超出的请求排队
+WPS_CONCURRENCY = int(os.environ.get("WPS_CONCURRENCY", "2"))
+# WPS 后端列表 "host:port,host:port"；未设置时使用 docker --link 的 WPS 后端
+WPS_BACKENDS = parse_endpoints(os.environ.get("WPS_BACKENDS", "")) or [(wps_api_host, 8000)]
+# 连续失败（连接失败或超时）多少次后暂停向该后端分配，/ready 探测恢复后重新加入
+WPS_EJECT_FAILURES = int(os.environ.get("WPS_EJECT_FAILURES", "3"))
+
+# 探测 WPS 后端 /ready 的间隔（秒）
+WPS_READY_INTERVAL = float(os.environ.get("WPS_READY_INTERVAL", "5"))
+# 源格式 => WPS 后端的实例类型
+WPS_KINDS = {"wps": "wps", "dps": "wpp"}
+
+# 在 lifespan 中创建
+wps_client: httpx.AsyncClient = None
+callback_client: httpx.AsyncClient = None
+
+
+class WpsBackend:
+    """
+    一个 WPS 后端：最近一次 /ready 探测的结果（含所有网关 worker 发来的转换造成的占用）、
+    本 worker 在该次探测之后发往它的转换数，以及连续失败的次数（达到 WPS_EJECT_FAILURES 后暂停分配，
+    直到探测到它恢复）
+    """
+
+    def __init__(self, host, port=8000):
+        self.url = f"http://{host}:{port}"
+        # None 表示尚未探测
+        self.ready = None
+        # 实例类型 => 可立即转换的 worker 数
+        self.warm = {}
+        # /ready 报告的 worker 数，即该后端可并行的转换数
+        self.workers = 1
+        # /ready 报告的空闲 worker 数与排队的转换数；None 表示尚未探测（或后端不报告）
+        self.free = None
+        self.queued = 0
+        # 每次探测递增；sent 为本 worker 在最近一次探测之后发出、尚未完成的转换数
+        self.generation = 0
+        self.sent = 0
+        self.busy = 0
+        self.failures = 0
+        self.ejected = False
+
+    async def probe(self):
+        try:
+            response = await wps_client.get(f"{self.url}/ready", timeout=5)
+            body = response.json()
+            warm = body.get("warm", {})
+            workers = len(body.get("workers", []))
+            free, queued = body.get("freeWorkers"), int(body.get("queued", 0))
+        except (httpx.HTTPError, ValueError, AttributeError, TypeError):
+            self.ready, self.warm, self.free = False, {}, None
+            self.record_failure()
+            return
+        self.ready, self.warm, self.workers = response.status_code == 200, warm, max(workers, 1)
+        # 之前发出的转换已反映在探测结果中
+        self.free, self.queued = free, queued
+        self.generation += 1
+        self.sent = 0
+        if self.ready:
+            if self.ejected:
+                print(f"WPS 后端 {self.url} 已恢复")
+            self.failures, self.ejected = 0, False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= WPS_EJECT_FAILURES and not self.ejected:
+            print(f"WPS 后端 {self.url} 连续失败 {self.failures} 次，暂停分配")
+            WPS_BACKEND_EJECTIONS.labels(self.url).inc()
+            self.ejected = True
+
+    def record_success(self):
+        self.failures = 0
+
+    def dispatch(self):
+        """记录一个发往该后端的转换，返回需交给 complete 的探测代次"""
+        self.busy += 1
+        self.sent += 1
+        return self.generation
+
+    def complete(self, generation):
+        self.busy -= 1
+        if generation == self.generation:
+            self.sent -= 1
+
+    def load(self):
+        """
+        占用的 worker 数（含排队）/ worker 数：按探测到的空闲 worker 数与排队数计算，
+        加上本 worker 在探测之后发出的转换；后端未报告空闲数时退回本 worker 的进行中转换数
+        """
+        if self.free is None:
+            return self.busy / self.workers
+        return (self.workers - self.free + self.queued + self.sent) / self.workers
+
+    def stats(self):
+        return {"url": self.url, "ready": self.ready, "warm": self.warm, "workers": self.workers,
+                "freeWorkers": self.free, "queued": self.queued, "busy": self.busy,
+                "load": round(self.load(), 2), "failures": self.failures, "ejected": self.ejected}
+
+
+wps_backends = [WpsBackend(host, port) for host, port in WPS_BACKENDS]
+
+
+def pick_wps_backend(source_type, exclude=()):
+    """
+    在未被暂停的后端中选择负载（见 WpsBackend.load）最低的，负载相同时优先有该类型热实例的，
+    仍相同时随机选择，避免各 worker 在两次探测之间都涌向同一个后端；
+    已探测为就绪的后端优先，都未就绪时仍从其余后端中选择，冷启动好过直接失败
+    """
+    kind = WPS_KINDS[source_type]
+    candidates = [b for b in wps_backends if not b.ejected and b not in exclude]
+    if not candidates:
+        raise ConversionError("No live WPS backend available", 503)
+    ready = [b for b in candidates if b.ready] or candidates
+    return min(ready, key=lambda b: (b.load(), not b.warm.get(kind), random.random()))
+
+
+async def monitor_wps_backends():
+    while True:
+        await asyncio.gather(*(backend.probe() for backend in wps_backends))
+        await asyncio.sleep(WPS_READY_INTERVAL)
+
+
+# ------------------------------------------------------------------------------
+# 跨 worker 的准入控制：各 uvicorn worker 转换前向同一个 broker 进程（unix socket）申请后端名额，
+# broker 按后端的实际并发能力放行，同一后端的等待者先按优先级（交互请求为 0，异步任务见 JOB_PRIORITIES），
+# 同一优先级内按客户端轮流放行，（预计）等待超过预算时返回 429 + Retry-After。
+# 名额随申请连接保持，连接关闭（包括 worker 崩溃）即释放；broker 不可用时退回到每个 worker 各自的限制。
+# ------------------------------------------------------------------------------
+ADMISSION_SOCKET = os.environ.get("ADMISSION_SOCKET", "/tmp/to_docx_admission.sock")
+# 交互请求等待名额的预算（秒）；异步任务与批量转换不受此限制
+ADMISSION_WAIT_BUDGET = float(os.environ.get("ADMISSION_WAIT_BUDGET", os.environ.get("WPS_QUEUE_TIMEOUT", "10")))
+# 各后端的并发上限，如 "libreoffice=4,wps=2,libreoffice:large=1"；默认每个 unoserver 实例同时只转换一个文档，
+# 大文件最多占用各后端一半的名额
+ADMISSION_LIMITS = {
+    "libreoffice": len(UNO_SERVERS),
+    "wps": WPS_CONCURRENCY * len(WPS_BACKENDS),
+    "libreoffice:large": max(len(UNO_SERVERS) // 2, 1),
+    "wps:large": max(WPS_CONCURRENCY * len(WPS_BACKENDS) // 2, 1),
+    **{
+        name.strip(): int(limit)
+        for name, _, limit in (item.partition("=") for item in os.environ.get("ADMISSION_LIMITS", "").split(",") if item)
+    },
+}
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+class AdmissionQueue:
+    """broker 中单个后端的名额与等待队列"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        # 优先级 => {客户端 => 该客户端的等待者}；先放行优先级值最小的，
+        # 同一优先级内按客户端轮流，避免单个客户端占满队列
+        self.waiters = {}
+        # 名额平均占用时间（秒）的指数加权平均，用于估算等待时间
+        self.avg_hold = None
+        self.admitted = 0
+        self.rejected = 0
+
+    def waiting(self, priority=None):
+        """等待者数；给出 priority 时只计优先级值不大于它的（排在它前面的）等待者"""
+        return sum(len(waiters) for rank, clients in self.waiters.items() if priority is None or rank <= priority
+                   for waiters in clients.values())
+
+    def estimated_wait(self, priority=None):
+        if self.avg_hold is None:
+            return 0
+        return (self.waiting(priority) + 1) / self.limit * self.avg_hold
+
+    async def acquire(self, client, budget, disconnected, priority=0):
+        """
+        等待名额，budget 为最长等待时间（秒，None 表示不限），priority 越小越先放行。
+        获得名额返回 True，客户端在等待期间断开返回 False，超出预算时抛出 AdmissionRejected。
+        """
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return True
+        estimate = self.estimated_wait(priority)
+        if budget is not None and estimate > budget:
+            raise AdmissionRejected(estimate)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(priority, OrderedDict()).setdefault(client, deque()).append(future)
+        try:
+            await asyncio.wait([future, disconnected], timeout=budget, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not future.done():
+                self._remove(priority, client, future)
+                future.cancel()
+        if not future.cancelled():
+            return True
+        if disconnected.done():
+            return False
+        raise AdmissionRejected(max(self.estimated_wait(priority), budget))
+
+    def release(self, held):
+        self.active -= 1
+        self.avg_hold = held if self.avg_hold is None else 0.8 * self.avg_hold + 0.2 * held
+        while self.active < self.limit and self.waiters:
+            priority = min(self.waiters)
+            clients = self.waiters[priority]
+            client, waiters = clients.popitem(last=False)
+            future = waiters.popleft()
+            if waiters:
+                # 该客户端其余的等待者排到同一优先级的队尾
+                clients[client] = waiters
+            if not clients:
+                del self.waiters[priority]
+            self.active += 1
+            future.set_result(True)
+
+    def _remove(self, priority, client, future):
+        clients = self.waiters[priority]
+        clients[client].remove(future)
+        if not clients[client]:
+            del clients[client]
+            if not clients:
+                del self.waiters[priority]
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting(),
+            "waitingByPriority": {rank: sum(len(waiters) for waiters in clients.values())
+                                  for rank, clients in sorted(self.waiters.items())},
+            "clients": len({client for clients in self.waiters.values() for client in clients}),
+            "avgHold": self.avg_hold and round(self.avg_hold, 2),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+class AdmissionBroker:
+    """
+    准入控制 broker（python main.py broker）。协议：每次申请建立一个连接并发送一行 JSON，
+    {"op": "acquire", "backend", "client", "budget", "priority"} 的回复为 {"ok": true}（之后保持连接直到释放）
+    或 {"ok": false, "retry_after"}；{"op": "stats"} 返回各后端的状态。
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.queues = {name: AdmissionQueue(limit) for name, limit in limits.items()}
+
+    async def handle(self, reader, writer):
+        disconnected = None
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            message = json.loads(line)
+            if message.get("op") == "stats":
+                reply = {name: queue.stats() for name, queue in self.queues.items()}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+                return
+            queue = self.queues[message["backend"]]
+            # 客户端释放名额或异常退出时连接关闭，read() 随之返回
+            disconnected = asyncio.ensure_future(reader.read())
+            try:
+                if not await queue.acquire(message["client"], message["budget"], disconnected,
+                                           message.get("priority", 0)):
+                    return
+            except AdmissionRejected as e:
+                queue.rejected += 1
+                writer.write(json.dumps({"ok": False, "retry_after": e.retry_after}).encode() + b"\n")
+                await writer.drain()
+                return
+            queue.admitted += 1
+            start = time.monotonic()
+            try:
+                writer.write(b'{"ok": true}\n')
+                await writer.drain()
+                await disconnected
+            finally:
+                queue.release(time.monotonic() - start)
+        except (ValueError, KeyError, ConnectionError) as e:
+            print("准入请求处理失败：", repr(e))
+        finally:
+            if disconnected is not None:
+                disconnected.cancel()
+            writer.close()
+
+    async def serve(self, path):
+        remove_files(path)
+        server = await asyncio.start_unix_server(self.handle, path=path)
+        print(f"admission broker listening on {path}, limits: {self.limits}")
+        async with server:
+            await server.serve_forever()
+
+
+class AdmissionClient:
+    """网关 worker 侧：向 broker 申请名额，broker 不可用时使用本进程内的信号量（不区分优先级）"""
+
+    def __init__(self, path, limits):
+        self.path = path
+        self.local = {name: asyncio.Semaphore(limit) for name, limit in limits.items()}
+        self.broker_down = False
+
+    @asynccontextmanager
+    async def slot(self, backend, client, budget, priority=0):
+        """占用一个 backend 名额；budget 为最长等待时间（秒），None 表示一直等待；priority 越小越先放行"""
+        ADMISSION_WAITING.labels(backend).inc()
+        try:
+            with stage("admission_wait"):
+                writer = await self._acquire(backend, client, budget, priority)
+        except Overloaded:
+            ADMISSION_REJECTED.labels(backend).inc()
+            raise
+        finally:
+            ADMISSION_WAITING.labels(backend).dec()
+        try:
+            yield
+        finally:
+            if writer is None:
+                self.local[backend].release()
+            else:
+                writer.close()
+
+    async def _acquire(self, backend, client, budget, priority):
+        """返回持有名额的连接；使用本地名额时返回 None"""
+        if self.path:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                message = {"op": "acquire", "backend": backend, "client": client, "budget": budget,
+                           "priority": priority}
+                writer.write(json.dumps(message).encode() + b"\n")
+                await writer.drain()
+                line = await reader.readline()
+            except OSError as e:
+                if writer is not None:
+                    writer.close()
+                if not self.broker_down:
+                    print("准入 broker 不可用，改用本地并发限制：", repr(e))
+                    self.broker_down = True
+            except BaseException:
+                if writer is not None:
+                    writer.close()
+                raise
+            else:
+                if line:
+                    self.broker_down = False
+                    reply = json.loads(line)
+                    if reply["ok"]:
+                        return writer
+                    writer.close()
+                    raise Overloaded(backend, reply["retry_after"])
+                # broker 在排队期间退出
+                writer.close()
+        try:
+            await asyncio.wait_for(self.local[backend].acquire(), budget)
+        except asyncio.TimeoutError:
+            raise Overloaded(backend, budget)
+        return None
+
+    async def stats(self):
+        if self.path:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                try:
+                    writer.write(b'{"op": "stats"}\n')
+                    await writer.drain()
+                    return {"broker": True, "backends": json.loads(await reader.readline())}
+                finally:
+                    writer.close()
+            except (OSError, ValueError):
+                pass
+        return {"broker": False, "available": {name: sem._value for name, sem in self.local.items()}}
+
+
+admission = AdmissionClient(ADMISSION_SOCKET, ADMISSION_LIMITS)
+
+
+@asynccontextmanager
+async def lane_slot(backend, input_path, client, budget, priority=0):
+    """占用一个 backend 名额；大文件先占用该后端的大文件通道名额（<backend>:large）"""
+    if file_lane(input_path) != "large":
+        async with admission.slot(backend, client, budget, priority):
+            yield
+        return
+    async with admission.slot(f"{backend}:large", client, budget, priority), \
+            admission.slot(backend, client, budget, priority):
+        yield
+
+
+def client_id(request: Request):
+    """公平排队所用的客户端标识：X-Client-ID 请求头，缺省为客户端地址"""
+    return request.headers.get("x-client-id") or (request.client.host if request.client else "anonymous")
+
+
+def extract_targets_archive(archive_path, outputs):
+    """将 WPS 后端返回的 zip（converted.<格式>）解压到各目标格式的结果文件"""
+    with zipfile.ZipFile(archive_path) as archive:
+        for target_type, output_path in outputs.items():
+            try:
+                src = archive.open(f"converted.{target_type}")
+            except KeyError:
+                raise ConversionError(f"WPS backend returned no {target_type} output", 502)
+            with src, open(output_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, SPOOL_CHUNK_SIZE)
+
+
+async def request_wps_backend(url: str, input_path: str, source_type: str, outputs: dict):
+    """
+    向一个 WPS 后端发送转换请求，outputs 为 目标格式 => 结果文件路径。
+    多个目标格式时 WPS 后端只打开一次文档并依次另存，返回包含 converted.<格式> 的 zip。
+    """
+    params = {"sourceType": source_type, "targetType": ",".join(outputs)}
+    headers = {"content-type": "application/octet-stream"}
+    trace = current_trace.get()
+    if trace is not None:
+        headers["x-request-id"] = trace.request_id
+    download_path = next(iter(outputs.values())) if len(outputs) == 1 else new_spool_path("zip")
+
+    try:
+        with stage("wps_backend"):
+            async with wps_client.stream("POST", f"{url}/convert/stream", params=params, headers=headers,
+                                         content=aiter_file(input_path)) as response:
+                if trace is not None:
+                    # WPS 后端各阶段（排队、打开、保存等）的耗时
+                    for name, seconds in parse_server_timing(response.headers.get("server-timing")):
+                        trace.record(f"wps.{name}", seconds)
+                if response.status_code != 200:
+                    body = await response.aread()
+                    try:
+                        message = json.loads(body).get("message", "未知错误")
+                    except ValueError:
+                        message = body.decode(errors="replace") or "未知错误"
+                    if response.status_code == 504:
+                        # WPS 后端的看门狗已结束超时的转换
+                        raise DeadlineExceeded(f"WPS backend error: {message}")
+                    raise ConversionError(f"WPS backend error: {message}",
+                                          422 if response.status_code == 422 else 502)
+                with open(download_path, "wb") as f:
+                    async for chunk in response.aiter_bytes(SPOOL_CHUNK_SIZE):
+                        f.write(chunk)
+            if len(outputs) > 1:
+                await asyncio.to_thread(extract_targets_archive, download_path, outputs)
+    except zipfile.BadZipFile as e:
+        raise ConversionError(f"WPS backend returned a bad archive: {e}", 502)
+    finally:
+        if len(outputs) > 1:
+            remove_files(download_path)
+
+
+async def convert_via_wps_backend(input_path: str, source_type: str, outputs: dict):
+    """选择一个 WPS 后端转换，结果写入 outputs 中的各个路径；连接失败时换下一个后端重试"""
+    tried = []
+    while True:
+        try:
+            backend = pick_wps_backend(source_type, exclude=tried)
+        except ConversionError:
+            if not tried:
+                raise
+            raise ConversionError(f"WPS backend unreachable: {last_error!r}", 502)
+        generation = backend.dispatch()
+        try:
+            await request_wps_backend(backend.url, input_path, source_type, outputs)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # 请求未送达，可以换一个后端重试
+            backend.record_failure()
+            tried.append(backend)
+            last_error = e
+            continue
+        except httpx.TimeoutException as e:
+            backend.record_failure()
+            raise ConversionError(f"WPS backend timeout: {e!r}", 504)
+        except httpx.TransportError as e:
+            backend.record_failure()
+            raise ConversionError(f"WPS backend unreachable: {e!r}", 502)
+        finally:
+            backend.complete(generation)
+        backend.record_success()
+        return
+
+
+# ------------------------------------------------------------------------------
+# 内容检测：按文件内容（而不是客户端声明的 sourceType）判断真实格式，
+# 改了扩展名的文件交给正确的后端，明显无法转换的输入在任何转换工作之前拒绝
+# ------------------------------------------------------------------------------
+SNIFF_BYTES = 4096
+OLE2_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+# 读取 OLE2 目录的扇区数上限（512 字节扇区中每个可存 4 个目录项）
+OLE2_MAX_DIRECTORY_SECTORS = 64
+# 金山 WPS 在 OLE2 复合文档中附加的流，同样结构的 MS Office 文档中没有
+WPS_OLE_STREAMS = {"WpsCustomData", "ETExtData"}
+# 只能由 WPS 后端打开的格式
+WPS_FORMATS = {"wps", "dps", "et"}
+# OOXML 包中的部件目录 => 格式
+OOXML_PARTS = {"word/": "docx", "xl/": "xlsx", "ppt/": "pptx"}
+ODF_MIMETYPES = {
+    "application/vnd.oasis.opendocument.text": "odt",
+    "application/vnd.oasis.opendocument.spreadsheet": "ods",
+    "application/vnd.oasis.opendocument.presentation": "odp",
+}
+ZIP_FORMATS = {"docx", "xlsx", "pptx", "odt", "ods", "odp"}
+
+
+def ole2_stream_names(f):
+    """OLE2 复合文档目录中的流名称，只读取文件头、FAT 和目录所在的扇区"""
+    f.seek(0)
+    header = f.read(512)
+    sector_size = 1 << struct.unpack_from("<H", header, 0x1E)[0]
+    if sector_size not in (512, 4096):
+        raise ValueError(f"bad sector size {sector_size}")
+    fat_count = struct.unpack_from("<I", header, 0x2C)[0]
+    fat_sectors = struct.unpack_from("<109I", header, 0x4C)[:fat_count]
+    entries_per_fat_sector = sector_size // 4
+    fat_cache = {}
+
+    def read_sector(sector):
+        f.seek((sector + 1) * sector_size)
+        data = f.read(sector_size)
+        if len(data) != sector_size:
+            raise ValueError(f"sector {sector} is out of range")
+        return data
+
+    def next_sector(sector):
+        index = sector // entries_per_fat_sector
+        if index >= len(fat_sectors):
+            # 目录链延伸到文件头之外的 FAT（超大文件），到此为止
+            return 0xFFFFFFFE
+        if index not in fat_cache:
+            fat_cache[index] = read_sector(fat_sectors[index])
+        return struct.unpack_from("<I", fat_cache[index], (sector % entries_per_fat_sector) * 4)[0]
+
+    names = set()
+    sector = struct.unpack_from("<I", header, 0x30)[0]
+    for _ in range(OLE2_MAX_DIRECTORY_SECTORS):
+        if sector >= 0xFFFFFFFA:
+            break
+        data = read_sector(sector)
+        for offset in range(0, sector_size, 128):
+            length = struct.unpack_from("<H", data, offset + 64)[0]
+            if 2 <= length <= 64:
+                names.add(data[offset:offset + length - 2].decode("utf-16-le", errors="replace"))
+        sector = next_sector(sector)
+    return names
+
+
+def ole2_format(names):
+    if "EncryptedPackage" in names:
+        raise ConversionError("Document is password-protected", 422)
+    wps = bool(names & WPS_OLE_STREAMS)
+    if "WordDocument" in names:
+        return "wps" if wps else "doc"
+    if "Workbook" in names or "Book" in names:
+        return "et" if wps else "xls"
+    if "PowerPoint Document" in names:
+        return "dps" if wps else "ppt"
+    return None
+
+
+def zip_format(path):
+    try:
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+            if "mimetype" in names:
+                mimetype = archive.read("mimetype")[:100].decode("ascii", errors="replace").strip()
+                if mimetype in ODF_MIMETYPES:
+                    return ODF_MIMETYPES[mimetype]
+            if "[Content_Types].xml" in names:
+                for prefix, fmt in OOXML_PARTS.items():
+                    if any(name.startswith(prefix) for name in names):
+                        return fmt
+    except zipfile.BadZipFile:
+        raise ConversionError("Corrupt zip container", 422)
+    raise ConversionError("Zip archive is not an office document", 422)
+
+
+def decode_text(head):
+    """head 看起来是文本时返回解码后的内容，否则返回 None"""
+    if any(b < 9 or 13 < b < 32 and b != 27 for b in head):
+        return None
+    for encoding in ("utf-8", "gb18030"):
+        try:
+            return head.decode(encoding)
+        except UnicodeDecodeError as e:
+            # 只是截断在多字节字符中间
+            if e.start >= len(head) - 4 and e.reason.startswith("unexpected end"):
+                return head[:e.start].decode(encoding)
+    return None
+
+
+def sniff_format(path):
+    """
+    根据文件开头（OLE2 与 zip 另读取其目录）判断格式：OLE2 复合文档按其中的流区分 doc/xls/ppt 与 wps/et/dps，
+    zip 区分 OOXML 与 ODF，另可识别 rtf、pdf 与文本（txt/html/xml）。无法识别时返回 None。
+    """
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_BYTES)
+        if not head:
+            raise ConversionError("Empty file", 422)
+        if head.startswith(OLE2_MAGIC):
+            try:
+                return ole2_format(ole2_stream_names(f))
+            except (struct.error, ValueError):
+                return None
+    if head.startswith(b"PK\x03\x04"):
+        return zip_format(path)
+    if b"%PDF-" in head[:1024]:
+        return "pdf"
+    if head.startswith(b"{\\rtf"):
+        return "rtf"
+    text = decode_text(head)
+    if text is None:
+        return None
+    text = text.lstrip("\ufeff \t\r\n").lower()
+    if text.startswith(("<!doctype html", "<html")):
+        return "html"
+    if text.startswith("<?xml"):
+        return "xml"
+    return "txt"
+
+
+def resolve_source_type(path, claimed):
+    """
+    返回用于转换的源格式：内容是可确定的文档格式且与声明不符时以内容为准；
+    文本内容只在声明为 WPS 格式时改为交给 LibreOffice（其余情况 LibreOffice 会按内容识别）。
+    内容明显无法转换时抛出 ConversionError(422)。
+    """
+    detected = sniff_format(path)
+    if detected in ("txt", "html", "xml"):
+        if claimed in WPS_FORMATS:
+            spreadsheet = document_family(claimed) == document_family("xls")
+            return "csv" if detected == "txt" and spreadsheet else detected
+        detected = None
+    if detected is None:
+        if claimed in ZIP_FORMATS:
+            raise ConversionError(f"File content is not a valid {claimed} document", 422)
+        return claimed
+    if detected == "ppt" and claimed == "dps":
+        # WPS 演示文稿与 ppt 的 OLE2 结构相同，无法区分，仍交给 WPS 后端
+        return claimed
+    return detected
+
+
+def link_spool_file(path, suffix):
+    """以新的扩展名在落盘目录中引用同一文件（硬链接，跨文件系统时复制）"""
+    linked_path = new_spool_path(suffix)
+    try:
+        os.remove(linked_path)
+        os.link(path, linked_path)
+    except OSError:
+        shutil.copyfile(path, linked_path)
+    return linked_path
+
+
+# ------------------------------------------------------------------------------
+# 转换路线规划：以两个后端各自能完成的转换为边，按代价找出最便宜的路线，
+# 单个后端无法完成的转换可以经中间格式接力，如 dps → pptx（WPS）→ pdf（LibreOffice）
+# ------------------------------------------------------------------------------
+# WPS 后端支持的转换：源格式 => 目标格式（同一类文档内另存）
+WPS_CAPABILITIES = {
+    "wps": ["docx", "doc", "pdf", "rtf", "html", "xml"],
+    "dps": ["pptx", "ppt"],
+}
+# 可作为接力的中间格式，代价相同时靠前的优先
+INTERMEDIATE_FORMATS = ["docx", "xlsx", "pptx", "doc", "xls", "ppt"]
+# 每一跳的相对代价，如 "wps=2,libreoffice=1"
+CONVERSION_COSTS = {
+    "libreoffice": 1.0,
+    "wps": 2.0,
+    **{
+        name.strip(): float(cost)
+        for name, _, cost in (item.partition("=") for item in os.environ.get("CONVERSION_COSTS", "").split(",") if item)
+    },
+}
+
+
+# 各类文档特有的格式，LibreOffice 不能在不同类别之间转换（如演示文稿转为文字文档）
+DOCUMENT_FAMILIES = [
+    {"doc", "docx", "odt", "rtf", "wps"},
+    {"xls", "xlsx", "ods", "csv", "et"},
+    {"ppt", "pptx", "odp", "dps"},
+]
+
+
+# 指标标签中保留的格式；客户端随意填写的其他格式一律记为 other，避免时间序列无限增长
+METRIC_FORMATS = set().union(*DOCUMENT_FAMILIES, WPS_CAPABILITIES, *WPS_CAPABILITIES.values(),
+                             {"pdf", "html", "xml", "txt", "png"})
+
+
+def metric_format(fmt: str):
+    return fmt if fmt in METRIC_FORMATS else "other"
+
+
+def document_family(fmt: str):
+    return next((i for i, family in enumerate(DOCUMENT_FAMILIES) if fmt in family), None)
+
+
+def libreoffice_supports(source_type: str, target_type: str):
+    if source_type == 'pdf' or source_type in WPS_CAPABILITIES or source_type == target_type:
+        return False
+    source_family, target_family = document_family(source_type), document_family(target_type)
+    return source_family is None or target_family is None or source_family == target_family
+
+
+def conversion_backend(source_type: str, target_type: str):
+    """能直接完成该转换的后端，不能时返回 None"""
+    if source_type in WPS_CAPABILITIES:
+        return "wps" if target_type in WPS_CAPABILITIES[source_type] else None
+    return "libreoffice" if libreoffice_supports(source_type, target_type) else None
+
+
+@functools.lru_cache(maxsize=None)
+def plan_route(source_type: str, target_type: str):
+    """代价最小的转换路线 ((后端, 源格式, 目标格式), ...)，无法转换时返回 None"""
+    order = itertools.count()
+    best = {source_type: 0.0}
+    heap = [(0.0, next(order), source_type, ())]
+    while heap:
+        cost, _, fmt, route = heapq.heappop(heap)
+        if fmt == target_type:
+            return route
+        if cost > best[fmt]:
+            continue
+        for next_fmt in [target_type, *INTERMEDIATE_FORMATS]:
+            backend = conversion_backend(fmt, next_fmt)
+            if backend is None:
+                continue
+            next_cost = cost + CONVERSION_COSTS[backend]
+            if next_cost < best.get(next_fmt, math.inf):
+                best[next_fmt] = next_cost
+                heapq.heappush(heap, (next_cost, next(order), next_fmt, route + ((backend, fmt, next_fmt),)))
+    return None
+
+
+def check_conversion(source_type: str, target_type: str):
+    """返回不支持该转换的原因，支持时返回 None"""
+    if source_type == 'pdf':
+        return "unsupported source file type"
+    if plan_route(source_type, target_type) is None:
+        return f"unsupported conversion from {source_type} to {target_type}"
+    return None
+
+
+def parse_targets(target_type):
+    """targetType 可以是单个格式、逗号分隔的多个格式或格式列表，返回去重后的列表"""
+    items = target_type if isinstance(target_type, list) else target_type.split(",")
+    return list(dict.fromkeys(t.strip() for t in items if t.strip()))
+
+
+def check_targets(source_type: str, targets: list):
+    if not targets:
+        return "missing target type"
+    for target_type in targets:
+        error = check_conversion(source_type, target_type)
+        if error:
+            return error
+    return None
+
+
+def write_targets_archive(outputs, archive_path):
+    """多个目标格式的结果打包为 zip，文件名为 converted.<格式>（与 WPS 后端一致）"""
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for target_type, output_path in outputs.items():
+            archive.write(output_path, f"converted.{target_type}")
+
+
+def result_label(error):
+    """转换异常在 docconv_conversions_total 中的 result 标签"""
+    if isinstance(error, Overloaded):
+        return "overloaded"
+    if isinstance(error, DeadlineExceeded):
+        return "deadline"
+    return "error"
+
+
+async def run_backend(backend: str, input_path: str, source_type: str, outputs: dict,
+                      client: str, wait_budget: float, priority: int = 0):
+    """在后端上转换 outputs 中的各个格式，返回 目标格式 => 异常（成功时为 None）"""
+    if backend == "wps":
+        try:
+            async with lane_slot(backend, input_path, client, wait_budget, priority):
+                await convert_via_wps_backend(input_path, source_type, outputs)
+        except Exception as e:
+            return dict.fromkeys(outputs, e)
+        return dict.fromkeys(outputs)
+
+    lane = file_lane(input_path)
+
+    async def convert_one(target_type, output_path):
+        async with lane_slot(backend, input_path, client, wait_budget, priority):
+            await run_in_executor(sync_convert_file, input_path, target_type, output_path,
+                                  deadline_for(source_type), lane=lane)
+
+    outcomes = await asyncio.gather(*(convert_one(t, path) for t, path in outputs.items()),
+                                    return_exceptions=True)
+    return dict(zip(outputs, outcomes))
+
+
+async def convert_on_backend(input_path: str, digest: str, source_type: str, outputs: dict,
+                             client: str = "anonymous", wait_budget: float = ADMISSION_WAIT_BUDGET,
+                             priority: int = 0):
+    """
+    在一个后端上将同一文档转换为一个或多个目标格式（路线中的一跳），
+    outputs 为 目标格式 => 结果文件路径，任一格式失败时抛出异常。
+    相同内容、相同转换参数的结果直接从缓存返回，只转换缓存中没有的格式；
+    相同的转换正在进行时（包括其他 worker 中），等待它的结果而不重复转换。
+    WPS 后端只打开一次文档、占用一个名额依次另存为各个格式；unoserver 无法保持打开的文档，
+    LibreOffice 按格式分别转换，各自申请名额，可分布到不同的 unoserver 上并行执行。
+    client、wait_budget 与 priority 用于准入控制：等待后端名额超过 wait_budget 秒时抛出 Overloaded；
+    等待相同的进行中转换不受 wait_budget 限制，先来者失败时等待者得到相同的异常。
+    """
+    # 当源格式为 wps 或 dps 时，使用 WPS 后端进行转换，否则走本地转换逻辑
+    backend = "wps" if source_type in WPS_CAPABILITIES else "libreoffice"
+    results = dict.fromkeys(outputs, "error")
+    cache_keys = {t: result_cache.make_key(digest, source_type, t) for t in outputs}
+    led, followed, locks, errors = {}, {}, {}, {}
+    try:
+        with stage("cache"):
+            for target_type, output_path in outputs.items():
+                if await asyncio.to_thread(result_cache.get_file, cache_keys[target_type], output_path):
+                    results[target_type] = "cached"
+                    continue
+                future = single_flight.join(cache_keys[target_type], output_path)
+                if future is None:
+                    led[target_type] = output_path
+                else:
+                    followed[target_type] = future
+
+        failure = None
+        try:
+            pending = dict(led)
+            if pending and result_cache.enabled:
+                # 其他 worker 正在进行相同的转换时，等它完成后从缓存读取结果（按键排序加锁，避免互相等待）
+                with stage("coalesce_wait"):
+                    for target_type in sorted(pending, key=cache_keys.get):
+                        locks[target_type] = await single_flight.lock(cache_keys[target_type])
+                for target_type in list(pending):
+                    if await asyncio.to_thread(result_cache.get_file, cache_keys[target_type], pending[target_type]):
+                        results[target_type] = "coalesced"
+                        errors[target_type] = None
+                        del pending[target_type]
+            if pending:
+                # 曾导致转换超时的文件直接拒绝
+                entry = quarantine.check(digest)
+                if entry is not None:
+                    results.update(dict.fromkeys(pending, "quarantined"))
+                    raise ConversionError(f"Document is quarantined: {entry['reason']}", 422)
+
+                converted = await run_backend(backend, input_path, source_type, pending, client, wait_budget,
+                                              priority)
+                errors.update(converted)
+                for target_type, error in converted.items():
+                    if error is None:
+                        results[target_type] = "ok"
+                        await asyncio.to_thread(result_cache.put_file, cache_keys[target_type], pending[target_type])
+                    else:
+                        results[target_type] = result_label(error)
+                failures = [e for e in converted.values() if e is not None]
+                if failures:
+                    blamed = next((e for e in failures if blames_document(e)), None)
+                    if blamed is not None:
+                        quarantine.add(digest, f"{blamed}")
+                    raise failures[0]
+        except BaseException as e:
+            failure = e if isinstance(e, Exception) else ConversionError("Conversion was cancelled", 503)
+            raise
+        finally:
+            for target_type, output_path in led.items():
+                single_flight.finish(cache_keys[target_type], output_path, errors.get(target_type, failure))
+            for target_type, fd in locks.items():
+                single_flight.unlock(cache_keys[target_type], fd)
+
+        if followed:
+            # 同一 worker 内相同的转换已在进行，等待其结果
+            with stage("coalesce_wait"):
+                outcomes = await asyncio.gather(
+                    *(single_flight.wait(cache_keys[t], future, outputs[t]) for t, future in followed.items()),
+                    return_exceptions=True)
+            failures = []
+            for target_type, outcome in zip(followed, outcomes):
+                if outcome is None:
+                    results[target_type] = "coalesced"
+                else:
+                    results[target_type] = result_label(outcome)
+                    failures.append(outcome)
+            if failures:
+                raise failures[0]
+    finally:
+        for target_type, result in results.items():
+            CONVERSIONS.labels(metric_format(source_type), metric_format(target_type), backend, result).inc()
+
+
+def route_label(route):
+    """多跳路线在指标中的 backend 标签，如 wps>libreoffice"""
+    return ">".join(backend for backend, _, _ in route)
+
+
+async def convert_targets(input_path: str, digest: str, source_type: str, outputs: dict,
+                          client: str = "anonymous", wait_budget: float = ADMISSION_WAIT_BUDGET, sniff: bool = True,
+                          priority: int = 0):
+    """
+    将同一文档转换为一个或多个目标格式，outputs 为 目标格式 => 结果文件路径，任一格式失败时抛出异常。
+    sniff 为 True 时先按文件内容确定真实的源格式（见 resolve_source_type）。
+    需要多跳的格式先在第一个后端转换为中间格式（中间结果按原文档缓存，之后换一个目标格式时可跳过这一跳），
+    再以中间文件为输入继续转换，中间文件只在网关的落盘目录中传递。
+    """
+    if sniff:
+        with stage("sniff"):
+            detected = await asyncio.to_thread(resolve_source_type, input_path, source_type)
+        if detected != source_type:
+            print(f"内容检测：声明为 {source_type}，实际为 {detected}")
+            SOURCE_MISMATCHES.labels(metric_format(source_type), detected).inc()
+            # 以正确的扩展名交给后端，LibreOffice 会参考扩展名选择导入过滤器
+            linked_path = await asyncio.to_thread(link_spool_file, input_path, detected)
+            try:
+                return await convert_targets(linked_path, digest, detected, outputs, client, wait_budget, sniff=False,
+                                             priority=priority)
+            finally:
+                remove_files(linked_path)
+
+    routes = {}
+    for target_type in outputs:
+        routes[target_type] = plan_route(source_type, target_type)
+        if routes[target_type] is None:
+            raise ConversionError(f"unsupported conversion from {source_type} to {target_type}", 422)
+    chained = {t: path for t, path in outputs.items() if len(routes[t]) > 1}
+    # 多跳的最终结果也按原文档缓存，命中时整条路线都不必执行
+    with stage("cache"):
+        for target_type in list(chained):
+            cache_key = result_cache.make_key(digest, source_type, target_type)
+            if await asyncio.to_thread(result_cache.get_file, cache_key, chained[target_type]):
+                CONVERSIONS.labels(metric_format(source_type), metric_format(target_type),
+                                   route_label(routes[target_type]), "cached").inc()
+                del chained[target_type]
+
+    first_hop = {t: path for t, path in outputs.items() if len(routes[t]) == 1}
+    intermediates = {}
+    for target_type in chained:
+        fmt = routes[target_type][0][2]
+        # 中间格式同时也是请求的目标格式时直接使用该结果
+        intermediates[fmt] = first_hop.get(fmt) or intermediates.get(fmt) or new_spool_path(fmt)
+    first_hop.update(intermediates)
+
+    async def continue_route(fmt):
+        targets = {t: chained[t] for t in chained if routes[t][0][2] == fmt}
+        result = "error"
+        try:
+            intermediate_digest = await asyncio.to_thread(file_digest, intermediates[fmt])
+            await convert_targets(intermediates[fmt], intermediate_digest, fmt, targets, client, wait_budget,
+                                  sniff=False, priority=priority)
+            result = "ok"
+            for target_type, output_path in targets.items():
+                cache_key = result_cache.make_key(digest, source_type, target_type)
+                await asyncio.to_thread(result_cache.put_file, cache_key, output_path)
+        finally:
+            for target_type in targets:
+                CONVERSIONS.labels(metric_format(source_type), metric_format(target_type),
+                                   route_label(routes[target_type]), result).inc()
+
+    try:
+        if first_hop:
+            await convert_on_backend(input_path, digest, source_type, first_hop, client, wait_budget, priority)
+        errors = await asyncio.gather(*(continue_route(fmt) for fmt in intermediates), return_exceptions=True)
+        for error in errors:
+            if error is not None:
+                raise error
+    finally:
+        remove_files(*(path for path in intermediates.values() if path not in outputs.values()))
+
+
+async def convert_document(input_path: str, digest: str, source_type: str, target_type: str, output_path: str,
+                           client: str = "anonymous", wait_budget: float = ADMISSION_WAIT_BUDGET, priority: int = 0):
+    """执行一次转换，结果写入 output_path，失败时抛出异常"""
+    await convert_targets(input_path, digest, source_type, {target_type: output_path}, client, wait_budget,
+                          priority=priority)
+
+
+@app.post("/convert", openapi_extra=json_body(ConvertRequest))
+async def convert_file(http_request: Request):
+    try:
+        request, input_path, digest = await spool_json_request(http_request, ConvertRequest)
+    except ConversionError as e:
+        # 落盘预算不足（503）或请求体过大（413）与过载一样明确返回状态码
+        if e.status_code in (413, 503):
+            return JSONResponse(status_code=e.status_code, content={"error": f"{e}"})
+        return JSONResponse(content={"error": f"{e}"})
     print(request.sourceType, "==>", request.targetType)
+    annotate(source=request.sourceType, target=request.targetType, bytes=os.path.getsize(input_path))
     # 针对不支持的类型直接返回错误信息
-    if request.sourceType == 'pdf':
-        return JSONResponse(content={"error": "unsupported source file type"})
-    if request.sourceType in ['ppt','pptx'] and request.targetType in ['doc','docx','xls','xlsx']:
-        return JSONResponse(content={"error": f"unsupported conversion from {request.sourceType} to {request.targetType}"})
-
-    # 当源格式为 wps 或 dps 时，使用 WPS 后端进行转换
-    if request.sourceType in ['wps', 'dps']:
-        result = await convert_via_wps_backend(request.fileBytes, request.sourceType, request.targetType)
-        if result.get("status") == "ok":
-            return Response(content=result["data"], media_type="application/octet-stream")
-        else:
-            # 统一由 convert_file 返回错误给客户端
-            print(f"WPS 后端转换失败: {result.get('message')}")
-            return JSONResponse(content={"error": f"WPS backend error: {result.get('message')}"})
+    targets = parse_targets(request.targetType)
+    error = check_targets(request.sourceType, targets)
+    if error:
+        remove_files(input_path)
+        return JSONResponse(content={"error": error})
 
-    # 否则走本地转换逻辑
-    binary_data = base64.b64decode(request.fileBytes)
+    outputs = {t: new_spool_path(t) for t in targets}
+    # 多个目标格式时返回 zip，其中为 converted.<格式>
+    output_path = outputs[targets[0]] if len(targets) == 1 else new_spool_path("zip")
     try:
-        result = await asyncio.get_event_loop().run_in_executor(
-            executor, sync_convert, binary_data, request.targetType
-        )
-        return Response(content=result, media_type="application/octet-stream")
+        await convert_targets(input_path, digest, request.sourceType, outputs, client_id(http_request))
+        if len(targets) > 1:
+            with stage("response"):
+                await asyncio.to_thread(write_targets_archive, outputs, output_path)
+            remove_files(*outputs.values())
     except Exception as e:
         print('执行转换失败：', request.sourceType, "==>", request.targetType, e)
+        remove_files(input_path, output_path, *outputs.values())
+        # 后端过载时明确返回 429 + Retry-After，其余错误沿用原有的 200 + {"error": ...}
+        if isinstance(e, Overloaded):
+            return JSONResponse(status_code=e.status_code, content={"error": f"{e}"}, headers=e.headers)
         return JSONResponse(content={"error": f"{e}"})
+    # 结果从落盘文件流式返回，不整块读入内存
+    media_type = "application/octet-stream" if len(targets) == 1 else "application/zip"
+    return FileResponse(output_path, media_type=media_type,
+                        background=BackgroundTask(remove_files, input_path, output_path))
+
+
+@app.post("/convert/stream")
+async def convert_stream(request: Request, sourceType: str, targetType: str):
+    """
+    二进制流式转换接口：请求体为原始文件内容（或 multipart 表单的 file 字段），
+    成功时直接返回转换后的文件，失败时返回非 200 状态码及 {"error": ...}。
+    targetType 为逗号分隔的多个格式时返回 zip，其中为 converted.<格式>
+    """
+    print(sourceType, "==>", targetType)
+    targets = parse_targets(targetType)
+    error = check_targets(sourceType, targets)
+    if error:
+        return JSONResponse(status_code=422, content={"error": error})
+
+    try:
+        input_path, digest = await spool_upload(request, sourceType)
+    except ConversionError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": f"{e}"})
+    annotate(source=sourceType, target=targetType, bytes=os.path.getsize(input_path))
+    outputs = {t: new_spool_path(t) for t in targets}
+    try:
+        await convert_targets(input_path, digest, sourceType, outputs, client_id(request))
+    except Exception as e:
+        print('执行转换失败：', sourceType, "==>", targetType, e)
+        remove_files(input_path, *outputs.values())
+        if isinstance(e, ConversionError):
+            return JSONResponse(status_code=e.status_code, content={"error": f"{e}"}, headers=e.headers)
+        return JSONResponse(status_code=500, content={"error": f"{e}"})
+    if len(targets) == 1:
+        output_path = outputs[targets[0]]
+        return FileResponse(output_path, media_type="application/octet-stream",
+                            background=BackgroundTask(remove_files, input_path, output_path))
+    archive_path = new_spool_path("zip")
+    try:
+        with stage("response"):
+            await asyncio.to_thread(write_targets_archive, outputs, archive_path)
+    except BaseException:
+        remove_files(input_path, archive_path)
+        raise
+    finally:
+        remove_files(*outputs.values())
+    return FileResponse(archive_path, media_type="application/zip",
+                        background=BackgroundTask(remove_files, input_path, archive_path))
+
 
 @app.post("/uploadfile")
 async def convert_file(
+    request: Request,
     file: UploadFile = File(...),
     target_format: str = "docx",
 ):
     """For test"""
-    binary_data = await file.read()
+    source_type = os.path.splitext(file.filename or "")[-1].strip(os.path.extsep).lower()
+    input_path, digest = await spool_stream(file, source_type)
+    annotate(source=source_type, target=target_format, bytes=os.path.getsize(input_path))
+    output_path = new_spool_path(target_format)
     # 执行转换
     try:
-        result = await asyncio.get_event_loop().run_in_executor(
-            executor, sync_convert, binary_data, target_format
-        )
-        return Response(content=result, media_type="application/octet-stream")
+        await convert_document(input_path, digest, source_type, target_format, output_path, client_id(request))
     except Exception as e:
         print(e)
+        remove_files(input_path, output_path)
+        return JSONResponse(content={"error": f"{e}"})
+    return FileResponse(output_path, media_type="application/octet-stream",
+                        background=BackgroundTask(remove_files, input_path, output_path))
+
+
+# ------------------------------------------------------------------------------
+# 预览：只渲染指定页（幻灯片）为 PNG 或 PDF，LibreOffice 按导出过滤器的 PageRange 只输出这些页，
+# 不必转换整份文档。LibreOffice 不能直接打开的格式（如 dps）先按转换路线转为其能打开的格式（该结果照常缓存）。
+# 预览结果单独缓存，不占用转换结果缓存的空间
+# ------------------------------------------------------------------------------
+PREVIEW_FORMATS = ("png", "pdf")
+# PNG 每页需要单独渲染一次，限制一次请求的页数
+PREVIEW_MAX_PAGES = int(os.environ.get("PREVIEW_MAX_PAGES", "10"))
+PREVIEW_DEFAULT_WIDTH = int(os.environ.get("PREVIEW_DEFAULT_WIDTH", "800"))
+
+preview_cache = ResultCache(
+    directory=os.environ.get("PREVIEW_CACHE_DIR", "/tmp/to_docx_preview_cache"),
+    max_bytes=int(os.environ.get("PREVIEW_CACHE_MAX_BYTES", str(256 * 1024 ** 2))),
+    ttl=float(os.environ.get("PREVIEW_CACHE_TTL", os.environ.get("CACHE_TTL", str(7 * 24 * 3600)))),
+)
+
+
+def parse_page_range(fmt: str, pages: str = None, first: int = None):
+    """pages 为 "3" 或 "2-5"，first 为前 N 页；都未指定时为第 1 页。返回 (起始页, 结束页)"""
+    if pages:
+        start, _, end = pages.partition("-")
+        try:
+            start, end = int(start), int(end or start)
+        except ValueError:
+            raise ConversionError(f"Invalid page range: {pages}", 422)
+    else:
+        start, end = 1, first or 1
+    if start < 1 or end < start:
+        raise ConversionError(f"Invalid page range: {pages or first}", 422)
+    if fmt == "png" and end - start + 1 > PREVIEW_MAX_PAGES:
+        raise ConversionError(f"At most {PREVIEW_MAX_PAGES} pages can be rendered as png", 422)
+    return start, end
+
+
+def preview_filter_options(fmt: str, page: str, width: int = None, height: int = None, dpi: int = None):
+    # PageRange 总是写成 "a-b"：unoserver 会把纯数字的值转换为整数，而 PageRange 须为字符串
+    options = [f"PageRange={page}"]
+    if fmt == "png":
+        options.append(f"PixelWidth={width or PREVIEW_DEFAULT_WIDTH}")
+        if height:
+            options.append(f"PixelHeight={height}")
+    elif dpi:
+        options += ["ReduceImageResolution=true", f"MaxImageResolution={dpi}"]
+    return options
+
+
+async def render_preview(input_path: str, digest: str, source_type: str, fmt: str, page_range: tuple,
+                         output_path: str, width: int = None, height: int = None, dpi: int = None,
+                         client: str = "anonymous", wait_budget: float = ADMISSION_WAIT_BUDGET):
+    """
+    渲染预览写入 output_path：PDF 为一个包含这些页的文件；PNG 单页时为图片，多页时为 zip（page-<页码>.png）。
+    """
+    start, end = page_range
+    # 最后一跳必须是 LibreOffice，PNG 只有 LibreOffice 能输出，以它的路线确定交给 LibreOffice 的格式
+    route = plan_route(source_type, "png")
+    if route is None or route[-1][0] != "libreoffice":
+        raise ConversionError(f"Preview is not supported for {source_type}", 422)
+    render_type = route[-1][1]
+    options_key = [fmt, start, end, width, height, dpi]
+    cache_key = preview_cache.make_key(digest, source_type, fmt, options_key)
+
+    result = "error"
+    temp_paths = []
+    try:
+        with stage("cache"):
+            if await asyncio.to_thread(preview_cache.get_file, cache_key, output_path):
+                result = "cached"
+                return
+        render_path = input_path
+        if render_type != source_type:
+            render_path = new_spool_path(render_type)
+            temp_paths.append(render_path)
+            await convert_targets(input_path, digest, source_type, {render_type: render_path}, client, wait_budget,
+                                  sniff=False)
+
+        async def render(page, path):
+            options = preview_filter_options(fmt, page, width, height, dpi)
+            async with lane_slot("libreoffice", render_path, client, wait_budget):
+                await run_in_executor(sync_convert_file, render_path, fmt, path, deadline_for(render_type), options,
+                                      lane=file_lane(render_path))
+
+        try:
+            if fmt == "pdf" or start == end:
+                await render(f"{start}-{end}", output_path)
+            else:
+                pages = {n: new_spool_path("png") for n in range(start, end + 1)}
+                temp_paths += pages.values()
+                await asyncio.gather(*(render(f"{n}-{n}", path) for n, path in pages.items()))
+                await asyncio.to_thread(write_pages_archive, pages, output_path)
+        except Overloaded:
+            result = "overloaded"
+            raise
+        except (DeadlineExceeded, BackendCrashed) as e:
+            result = result_label(e)
+            if blames_document(e):
+                quarantine.add(digest, f"{e}")
+            raise
+        result = "ok"
+        await asyncio.to_thread(preview_cache.put_file, cache_key, output_path)
+    finally:
+        remove_files(*temp_paths)
+        PREVIEWS.labels(metric_format(source_type), fmt, result).inc()
+
+
+def write_pages_archive(pages, archive_path):
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_STORED) as archive:
+        for page, path in pages.items():
+            archive.write(path, f"page-{page}.png")
+
+
+@app.post("/preview")
+async def preview(request: Request, sourceType: str, format: str = "png", pages: str = None, first: int = None,
+                  width: int = None, height: int = None, dpi: int = None):
+    """
+    快速预览：请求体为原始文件内容（或 multipart 表单的 file 字段），
+    pages 为页码或页码范围（如 2-5），first 为前 N 页，默认第 1 页；
+    format 为 png（width/height 为像素尺寸，多页时返回 zip）或 pdf（dpi 限制其中图片的分辨率）
+    """
+    if format not in PREVIEW_FORMATS:
+        return JSONResponse(status_code=422, content={"error": f"unsupported preview format {format}"})
+    try:
+        page_range = parse_page_range(format, pages, first)
+    except ConversionError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": f"{e}"})
+    try:
+        input_path, digest = await spool_upload(request, sourceType)
+    except ConversionError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": f"{e}"})
+    annotate(source=sourceType, target=format, pages=f"{page_range[0]}-{page_range[1]}",
+             bytes=os.path.getsize(input_path))
+    output_path = new_spool_path("zip" if format == "png" and page_range[0] != page_range[1] else format)
+    temp_paths = [input_path]
+    try:
+        with stage("sniff"):
+            source_type = await asyncio.to_thread(resolve_source_type, input_path, sourceType)
+        if source_type != sourceType:
+            SOURCE_MISMATCHES.labels(metric_format(sourceType), source_type).inc()
+            input_path = await asyncio.to_thread(link_spool_file, input_path, source_type)
+            temp_paths.append(input_path)
+        entry = quarantine.check(digest)
+        if entry is not None:
+            raise ConversionError(f"Document is quarantined: {entry['reason']}", 422)
+        await render_preview(input_path, digest, source_type, format, page_range, output_path,
+                             width, height, dpi, client_id(request))
+    except Exception as e:
+        print('生成预览失败：', sourceType, "==>", format, e)
+        remove_files(*temp_paths, output_path)
+        if isinstance(e, ConversionError):
+            return JSONResponse(status_code=e.status_code, content={"error": f"{e}"}, headers=e.headers)
+        return JSONResponse(status_code=500, content={"error": f"{e}"})
+    media_type = {"png": "image/png", "pdf": "application/pdf", "zip": "application/zip"}
+    return FileResponse(output_path, media_type=media_type[output_path.rsplit(".", 1)[-1]],
+                        background=BackgroundTask(remove_files, *temp_paths, output_path))
+
+
+# ------------------------------------------------------------------------------
+# 异步任务：提交后立即返回任务 id，由后台按优先级排队转换，完成后可轮询或回调通知
+# ------------------------------------------------------------------------------
+# 任务目录，需被所有 uvicorn worker 共享，以便任意 worker 都能查询任务状态
+JOBS_DIR = os.environ.get("JOBS_DIR", "/tmp/to_docx_jobs")
+# 每个网关 worker 中执行任务的协程数
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# 每个网关 worker 的排队任务上限，超出时拒绝提交
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "1000"))
+# 已结束任务（含结果文件）的保留时间（秒）
+JOB_TTL = float(os.environ.get("JOB_TTL", str(24 * 3600)))
+# 优先级名称 => 排序值，值越小越先执行；转换时以该值向准入 broker 申请后端名额（同步接口的请求为 0）
+JOB_PRIORITIES = {"interactive": 0, "normal": 5, "bulk": 9}
+
+
+class JobRequest(ConvertRequest):
+    targetType: str
+    priority: str = "normal"
+    callbackUrl: str = None
+
+
+class JobQueue:
+    """
+    有界优先级任务队列。任务状态以 job.json 的形式保存在 JOBS_DIR 下。
+    每个 worker 进程从自己的队列中取任务，转换时以任务的优先级向准入 broker 申请后端名额，
+    不同 worker 的任务之间的先后由 broker 决定。
+    排队中、执行中的任务在 JOBS_DIR/.queued、JOBS_DIR/.running 下各有一个标记文件（<优先级>.<任务 id>），
+    任务平均耗时保存在 JOBS_DIR/.stats.json，队列深度与预计等待时间据此按所有 worker 统计。
+    """
+
+    def __init__(self, directory, workers, maxsize, ttl):
+        self.directory = directory
+        self.workers = workers
+        self.ttl = ttl
+        self.queue = asyncio.PriorityQueue(maxsize=maxsize)
+        self.seq = itertools.count()
+        self.stats_path = os.path.join(directory, ".stats.json")
+        self.last_sweep = 0
+
+    def _dir(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def _write(self, job):
+        path = os.path.join(self._dir(job["id"]), "job.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    def load(self, job_id):
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self._dir(job_id), "job.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def result_path(self, job):
+        return os.path.join(self._dir(job["id"]), f"result.{job['targetType']}")
+
+    def _marker(self, state, priority, job_id):
+        return os.path.join(self.directory, f".{state}", f"{priority}.{job_id}")
+
+    def _move_marker(self, priority, job_id, src, dst=None):
+        """将任务的标记文件从 src 状态移到 dst 状态，dst 为 None 时删除"""
+        try:
+            if dst is None:
+                os.remove(self._marker(src, priority, job_id))
+            else:
+                os.replace(self._marker(src, priority, job_id), self._marker(dst, priority, job_id))
+        except FileNotFoundError:
+            pass
+
+    def counts(self, state):
+        """所有 worker 中处于 state（queued 或 running）的任务数，按优先级统计"""
+        counts = dict.fromkeys(JOB_PRIORITIES, 0)
+        try:
+            names = os.listdir(os.path.join(self.directory, f".{state}"))
+        except FileNotFoundError:
+            return counts
+        for name in names:
+            priority = name.partition(".")[0]
+            if priority in counts:
+                counts[priority] += 1
+        return counts
+
+    def avg_duration(self):
+        """任务耗时（从开始执行到结束，含等待后端名额的时间）的指数滑动平均，尚无统计时返回 None"""
+        try:
+            with open(self.stats_path) as f:
+                return json.load(f)["avgDuration"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def record_duration(self, duration):
+        """更新各 worker 共用的平均耗时；多个 worker 同时更新时个别样本可能丢失，不影响估算"""
+        avg = self.avg_duration()
+        avg = duration if avg is None else 0.8 * avg + 0.2 * duration
+        with open(f"{self.stats_path}.{os.getpid()}.tmp", "w") as f:
+            json.dump({"avgDuration": avg}, f)
+        os.replace(f"{self.stats_path}.{os.getpid()}.tmp", self.stats_path)
+
+    def estimated_wait(self, priority, queued=None, running=None):
+        """
+        按所有 worker 中排在前面的任务数估算等待时间（秒），尚无统计时返回 None。
+        任务的吞吐量取 执行中的任务数 / 平均耗时（Little 定律）
+        """
+        avg = self.avg_duration()
+        if avg is None:
+            return None
+        queued = self.counts("queued") if queued is None else queued
+        running = sum(self.counts("running").values()) if running is None else running
+        rank = JOB_PRIORITIES[priority]
+        ahead = sum(n for name, n in queued.items() if JOB_PRIORITIES[name] <= rank)
+        return round(ahead * avg / max(running, 1), 1)
+
+    def submit(self, input_path, digest, source_type, target_type, priority, callback_url, client="anonymous"):
+        """登记任务并加入队列；输入文件被移动到任务目录。队列已满时抛出 ConversionError"""
+        if priority not in JOB_PRIORITIES:
+            raise ConversionError(f"unknown priority {priority}, expected one of {list(JOB_PRIORITIES)}", 422)
+        if self.queue.full():
+            raise ConversionError("job queue is full", 503)
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._dir(job_id))
+        job_input = os.path.join(self._dir(job_id), f"input.{source_type}")
+        shutil.move(input_path, job_input)
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "sourceType": source_type,
+            "targetType": target_type,
+            "priority": priority,
+            "digest": digest,
+            "callbackUrl": callback_url,
+            "client": client,
+            "requestId": current_request_id(),
+            "created": time.time(),
+            "estimatedWait": self.estimated_wait(priority),
+            "error": None,
+        }
+        self._write(job)
+        open(self._marker("queued", priority, job_id), "w").close()
+        self.queue.put_nowait((JOB_PRIORITIES[priority], next(self.seq), priority, job_id))
+        JOB_QUEUE_DEPTH.inc()
+        return job
+
+    def stats(self):
+        """所有 worker 的任务队列深度、执行中的任务数与各优先级的预计等待时间"""
+        queued, running = self.counts("queued"), self.counts("running")
+        avg = self.avg_duration()
+        return {
+            "depth": sum(queued.values()),
+            "depthByPriority": queued,
+            "running": sum(running.values()),
+            "runningByPriority": running,
+            "avgDuration": avg and round(avg, 2),
+            "estimatedWait": {name: self.estimated_wait(name, queued, sum(running.values()))
+                              for name in JOB_PRIORITIES},
+        }
+
+    def start(self):
+        for state in ("queued", "running"):
+            os.makedirs(os.path.join(self.directory, f".{state}"), exist_ok=True)
+        return [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self, tasks):
+        for task in tasks:
+            task.cancel()
+        # 进程退出时仍在排队的任务无法继续执行，标记为失败
+        while not self.queue.empty():
+            _, _, priority, job_id = self.queue.get_nowait()
+            JOB_QUEUE_DEPTH.dec()
+            self._move_marker(priority, job_id, "queued")
+            job = self.load(job_id)
+            if job is not None:
+                job.update(status="failed", error="server shutdown before the job ran", finished=time.time())
+                self._write(job)
+
+    async def worker(self):
+        while True:
+            _, _, priority, job_id = await self.queue.get()
+            JOB_QUEUE_DEPTH.dec()
+            job = self.load(job_id)
+            if job is None:
+                self._move_marker(priority, job_id, "queued")
+                continue
+            # 任务沿用提交请求的 id，结束后单独输出一行耗时日志
+            trace = Trace(job.get("requestId") or job_id)
+            token = current_trace.set(trace)
+            observe_stage("job_queue_wait", time.time() - job["created"])
+            self._move_marker(priority, job_id, "queued", "running")
+            try:
+                await self.run(job)
+            finally:
+                self._move_marker(priority, job_id, "running")
+                current_trace.reset(token)
+                if TRACE_LOG:
+                    trace.log(event="job", jobId=job_id, source=job["sourceType"], target=job["targetType"],
+                              priority=priority, status=job["status"])
+            await self.notify(job)
+            await asyncio.to_thread(self.sweep)
+
+    async def run(self, job):
+        job.update(status="running", started=time.time())
+        self._write(job)
+        input_path = os.path.join(self._dir(job["id"]), f"input.{job['sourceType']}")
+        try:
+            # 后台任务不设等待预算，在后端名额上按任务的优先级一直排队
+            await convert_document(input_path, job["digest"], job["sourceType"], job["targetType"],
+                                   self.result_path(job), job.get("client", "anonymous"), wait_budget=None,
+                                   priority=JOB_PRIORITIES[job["priority"]])
+            job["status"] = "done"
+        except Exception as e:
+            print('任务转换失败：', job["id"], job["sourceType"], "==>", job["targetType"], e)
+            job.update(status="failed", error=f"{e}")
+            remove_files(self.result_path(job))
+        finally:
+            remove_files(input_path)
+        job["finished"] = time.time()
+        self._write(job)
+        await asyncio.to_thread(self.record_duration, job["finished"] - job["started"])
+
+    async def notify(self, job, retries=3):
+        """任务结束后向 callbackUrl POST 任务状态，失败时退避重试"""
+        if not job.get("callbackUrl"):
+            return
+        payload = job_view(job)
+        for attempt in range(retries):
+            try:
+                response = await callback_client.post(job["callbackUrl"], json=payload,
+                                                      headers={"x-request-id": job.get("requestId") or job["id"]})
+                if response.status_code < 500:
+                    return
+            except httpx.HTTPError as e:
+                print('任务回调失败：', job["id"], e)
+            await asyncio.sleep(2 ** attempt)
+
+    def sweep(self, interval=600):
+        """删除超过保留时间的已结束任务，以及已结束或因 worker 退出而不会再执行的任务的标记文件"""
+        now = time.time()
+        if now - self.last_sweep < interval:
+            return
+        self.last_sweep = now
+        for job_id in os.listdir(self.directory):
+            job = self.load(job_id)
+            if job and job.get("finished") and now - job["finished"] > self.ttl:
+                shutil.rmtree(self._dir(job_id), ignore_errors=True)
+        for state in ("queued", "running"):
+            for name in os.listdir(os.path.join(self.directory, f".{state}")):
+                priority, _, job_id = name.partition(".")
+                job = self.load(job_id)
+                if job is None or job.get("finished") or now - job["created"] > self.ttl:
+                    self._move_marker(priority, job_id, state)
+
+
+job_queue = JobQueue(JOBS_DIR, JOB_WORKERS, JOB_QUEUE_SIZE, JOB_TTL)
+
+
+def job_view(job):
+    """返回给客户端的任务状态"""
+    view = {k: job.get(k) for k in ("id", "status", "sourceType", "targetType", "priority",
+                                     "created", "started", "finished", "estimatedWait", "error")}
+    if job["status"] == "done":
+        view["resultUrl"] = f"/jobs/{job['id']}/result"
+    return view
+
+
+@app.post("/jobs", openapi_extra=json_body(JobRequest))
+async def submit_job(http_request: Request):
+    """以 JSON（base64 文件内容）提交异步转换任务"""
+    try:
+        request, input_path, digest = await spool_json_request(http_request, JobRequest)
+    except ConversionError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": f"{e}"})
+    error = check_conversion(request.sourceType, request.targetType)
+    if error:
+        remove_files(input_path)
+        return JSONResponse(status_code=422, content={"error": error})
+    try:
+        job = job_queue.submit(input_path, digest, request.sourceType,
+                               request.targetType, request.priority, request.callbackUrl,
+                               client_id(http_request))
+    except ConversionError as e:
+        remove_files(input_path)
+        return JSONResponse(status_code=e.status_code, content={"error": f"{e}"})
+    return JSONResponse(status_code=202, content=job_view(job))
+
+
+@app.post("/jobs/stream")
+async def submit_job_stream(request: Request, sourceType: str, targetType: str,
+                            priority: str = "normal", callbackUrl: str = None):
+    """以二进制请求体（或 multipart 表单的 file 字段）提交异步转换任务"""
+    error = check_conversion(sourceType, targetType)
+    if error:
+        return JSONResponse(status_code=422, content={"error": error})
+    input_path = None
+    try:
+        input_path, digest = await spool_upload(request, sourceType)
+        job = job_queue.submit(input_path, digest, sourceType, targetType, priority, callbackUrl,
+                               client_id(request))
+    except ConversionError as e:
+        if input_path:
+            remove_files(input_path)
+        return JSONResponse(status_code=e.status_code, content={"error": f"{e}"})
+    return JSONResponse(status_code=202, content=job_view(job))
+
+
+@app.get("/jobs")
+async def job_stats():
+    """所有 worker 的任务队列深度与预计等待时间"""
+    return await asyncio.to_thread(job_queue.stats)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_queue.load(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "job not found"})
+    return job_view(job)
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = job_queue.load(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "job not found"})
+    if job["status"] != "done":
+        return JSONResponse(status_code=409, content={"error": f"job is {job['status']}"})
+    return FileResponse(job_queue.result_path(job), media_type="application/octet-stream")
+
+
+# ------------------------------------------------------------------------------
+# 批量转换：一次上传多个文档（zip 或 multipart 多文件），返回包含全部结果的 zip
+# ------------------------------------------------------------------------------
+# 单个批量请求内同时进行的转换数
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "8"))
+# 单个批量请求的文件数上限，以及（解压后）文件总字节数上限
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "1000"))
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", str(2 * 1024 ** 3)))
+# 未指定目标格式时的默认映射，与批量转换客户端（main.go）一致
+DEFAULT_TARGETS = {
+    "ppt": "pptx", "dps": "pptx",
+    "doc": "docx", "wps": "docx",
+    "xls": "xlsx", "et": "xlsx",
+}
+
+
+def file_type(name):
+    return os.path.splitext(name)[-1].strip(os.path.extsep).lower()
+
+
+class BatchQuota:
+    """批量请求剩余可接收的文件数与（解压后）字节数，超出时抛出 413"""
+
+    def __init__(self, max_files=BATCH_MAX_FILES, max_bytes=BATCH_MAX_BYTES):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.files = 0
+        self.bytes = 0
+
+    def add_files(self, count):
+        self.files += count
+        if self.files > self.max_files:
+            raise ConversionError(f"Batch exceeds {self.max_files} files", 413)
+
+    def add_bytes(self, nbytes):
+        self.bytes += nbytes
+        if self.bytes > self.max_bytes:
+            raise ConversionError(f"Batch exceeds {self.max_bytes} bytes (uncompressed)", 413)
+
+    def remaining_bytes(self):
+        return self.max_bytes - self.bytes
+
+
+async def spool_batch(request: Request):
+    """
+    将批量请求中的文档逐个落盘（磁盘上的 DISK_SPOOL_DIR），返回 [(原文件名, 落盘路径, 内容哈希)] 及表单参数。
+    请求体可以是 zip 压缩包，也可以是 multipart 表单（files 字段可重复，其中的 zip 会被展开）。
+    文件数或解压后的总大小超过 BATCH_MAX_FILES / BATCH_MAX_BYTES 时抛出 413
+    """
+    quota = BatchQuota()
+    uploads = []
+    params = {}
+    documents = []
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            for key, value in form.multi_items():
+                if isinstance(value, str):
+                    params[key] = value
+                else:
+                    path, digest = await spool_stream(value, file_type(value.filename or ""),
+                                                      DISK_SPOOL_DIR, quota.remaining_bytes())
+                    uploads.append((value.filename or key, path, digest))
+        else:
+            path, digest = await spool_upload(request, "zip", DISK_SPOOL_DIR, quota.max_bytes)
+            uploads.append(("upload.zip", path, digest))
+
+        for name, path, digest in uploads:
+            if file_type(name) == "zip":
+                documents.extend(await asyncio.to_thread(extract_zip, path, quota))
+                remove_files(path)
+            else:
+                quota.add_files(1)
+                quota.add_bytes(os.path.getsize(path))
+                documents.append((name, path, digest))
+    except zipfile.BadZipFile:
+        remove_files(*(d[1] for d in documents), *(u[1] for u in uploads))
+        raise ConversionError("invalid zip archive", 400)
+    except BaseException:
+        remove_files(*(d[1] for d in documents), *(u[1] for u in uploads))
+        raise
+    return documents, params
+
+
+def extract_zip(zip_path, quota):
+    """
+    将 zip 中的文件逐个解压到磁盘上的落盘目录（不使用包内路径，避免路径穿越）。
+    解压前按文件头中的数量与大小检查 quota，解压时再按实际写出的字节数检查
+    """
+    documents = []
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            entries = [info for info in archive.infolist() if not info.is_dir()]
+            quota.add_files(len(entries))
+            if sum(info.file_size for info in entries) > quota.remaining_bytes():
+                raise ConversionError(f"Batch exceeds {quota.max_bytes} bytes (uncompressed)", 413)
+            for info in entries:
+                path = new_disk_spool_path(file_type(info.filename))
+                documents.append((info.filename, path, None))
+                digest = hashlib.sha256()
+                with archive.open(info) as src, open(path, "wb") as dst:
+                    while chunk := src.read(SPOOL_CHUNK_SIZE):
+                        quota.add_bytes(len(chunk))
+                        digest.update(chunk)
+                        dst.write(chunk)
+                documents[-1] = (info.filename, path, digest.hexdigest())
+    except BaseException:
+        remove_files(*(d[1] for d in documents))
+        raise
+    return documents
+
+
+class BatchArchive:
+    """
+    批量转换的结果 zip：每个文件转换完成后立即写入并可删除其结果文件，最后写入 manifest.json。
+    结果文件名重复时追加 _(原文件名)，仍重复时再追加序号。add 在线程中执行，调用方需保证同一时刻只有一个 add
+    """
+
+    def __init__(self, archive_path):
+        self.archive = zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED)
+        self.used = set()
+
+    def add(self, item, output_path):
+        # 去掉包内路径中的 ".." 等部分，避免客户端解压时路径穿越
+        safe_name = "/".join(p for p in item["name"].replace("\\", "/").split("/")
+                             if p not in ("", ".", ".."))
+        stem = os.path.splitext(safe_name)[0]
+        name = f"{stem}.{item['targetType']}"
+        if name in self.used:
+            name = f"{stem}_({os.path.basename(item['name'])}).{item['targetType']}"
+        # 同名文件不止两个时继续追加序号，直到名称未被使用
+        base, counter = os.path.splitext(name)[0], 2
+        while name in self.used:
+            name = f"{base}_{counter}.{item['targetType']}"
+            counter += 1
+        self.used.add(name)
+        self.archive.write(output_path, name)
+        item["output"] = name
+        item["size"] = os.path.getsize(output_path)
+
+    def close(self, manifest):
+        self.archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+        self.archive.close()
+
+
+@app.post("/batch")
+async def convert_batch(request: Request, targetType: str = None, targets: str = None):
+    """
+    批量转换。目标格式优先取 targets（JSON：{"原文件名": "目标格式"}）中的值，
+    其次取 targetType，都未指定时按 DEFAULT_TARGETS 推断。
+    返回 zip，其中 manifest.json 记录每个文件的转换状态。
+    """
+    try:
+        documents, params = await spool_batch(request)
+    except ConversionError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": f"{e}"})
+    target_type = params.get("targetType", targetType)
+    try:
+        target_map = json.loads(params.get("targets", targets) or "{}")
+    except ValueError:
+        remove_files(*(d[1] for d in documents))
+        return JSONResponse(status_code=400, content={"error": "targets must be a JSON object"})
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    client = client_id(request)
+    archive_path = new_disk_spool_path("zip")
+    archive = BatchArchive(archive_path)
+    archive_lock = asyncio.Lock()
+
+    async def convert_one(name, input_path, digest):
+        source = file_type(name)
+        target = target_map.get(name) or target_type or DEFAULT_TARGETS.get(source, "pdf")
+        item = {"name": name, "sourceType": source, "targetType": target, "status": "ok", "error": None}
+        error = check_conversion(source, target)
+        if error:
+            remove_files(input_path)
+            item.update(status="error", error=error)
+            return item
+        output_path = new_disk_spool_path(target)
+        try:
+            async with semaphore:
+                try:
+                    # 整批一起返回，单个文件不设等待预算
+                    await convert_document(input_path, digest, source, target, output_path, client, wait_budget=None)
+                except Exception as e:
+                    print('批量转换失败：', name, source, "==>", target, e)
+                    item.update(status="error", error=f"{e}")
+            if item["status"] == "ok":
+                # 完成一个写入一个，结果文件不在落盘目录中累积
+                async with archive_lock:
+                    await asyncio.to_thread(archive.add, item, output_path)
+        finally:
+            remove_files(input_path, output_path)
+        return item
+
+    print(f"批量转换 {len(documents)} 个文件")
+    try:
+        manifest = await asyncio.gather(*(convert_one(*d) for d in documents))
+        await asyncio.to_thread(archive.close, manifest)
+    except BaseException:
+        archive.archive.close()
+        remove_files(archive_path, *(d[1] for d in documents))
+        raise
+    return FileResponse(archive_path, media_type="application/zip", filename="converted.zip",
+                        background=BackgroundTask(remove_files, archive_path))
+
+
+@app.get("/unoservers")
+async def unoservers():
+    """当前 worker 进程视角下各 unoserver 实例的负载与存活状态"""
+    return uno_balancer.stats()
+
+
+@app.get("/wpsbackends")
+async def wps_backend_stats():
+    """当前 worker 进程最近一次探测到的 WPS 后端就绪状态与热容量"""
+    return [backend.stats() for backend in wps_backends]
+
+
+@app.get("/admission")
+async def admission_stats():
+    """
+    各后端的并发上限、占用与排队情况（来自 broker；broker 不可用时为本 worker 的本地名额），
+    以及本 worker 的内存预算占用
+    """
+    return {**await admission.stats(), "memory": memory_budget.stats(), "spool": spool_budget.stats()}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """当前 worker 进程的缓存命中统计，以及合并的进行中转换"""
+    return {**result_cache.stats(), **single_flight.stats()}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指标；设置了 PROMETHEUS_MULTIPROC_DIR 时汇总所有 worker 进程"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
 
 
 if __name__ == "__main__":
-    print("start uvicorn server...")
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    if sys.argv[1:] == ["broker"]:
+        asyncio.run(AdmissionBroker(ADMISSION_LIMITS).serve(ADMISSION_SOCKET))
+    else:
+        print("start uvicorn server...")
+        uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
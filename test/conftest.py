@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 导入 mainweb 时会创建落盘、缓存等目录，测试中全部放到临时目录下
+_workdir = tempfile.mkdtemp(prefix="to_docx_test_")
+for _name in ("SPOOL_DIR", "DISK_SPOOL_DIR", "CACHE_DIR", "PREVIEW_CACHE_DIR", "QUARANTINE_DIR",
+              "JOBS_DIR", "UNO_LOCK_DIR"):
+    os.environ.setdefault(_name, os.path.join(_workdir, _name.lower()))
+os.environ.setdefault("TRACE_LOG", "0")
+
+sys.path.insert(0, ROOT)
@@ -0,0 +1,50 @@
+import asyncio
+
+import mainweb
+
+
+def test_admission_queue_priority():
+    """名额先放行优先级值小的等待者，同一优先级内按客户端轮流"""
+
+    async def scenario():
+        queue = mainweb.AdmissionQueue(1)
+        never = asyncio.get_running_loop().create_future()
+        assert await queue.acquire("a", None, never)
+        order = []
+
+        async def wait(client, priority):
+            await queue.acquire(client, None, never, priority)
+            order.append((client, priority))
+
+        tasks = [asyncio.create_task(wait(client, priority))
+                 for client, priority in [("bulk", 9), ("bulk", 9), ("x", 5), ("x", 5), ("y", 5), ("i", 0)]]
+        await asyncio.sleep(0)
+        assert queue.stats()["waitingByPriority"] == {0: 1, 5: 3, 9: 2}
+        for _ in tasks:
+            queue.release(1)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == [("i", 0), ("x", 5), ("y", 5), ("x", 5), ("bulk", 9), ("bulk", 9)]
+
+
+def test_job_stats_shared_between_workers(tmp_path):
+    """两个 worker 进程（各自的 JobQueue）共用任务目录时，队列深度按所有 worker 统计"""
+    queues = [mainweb.JobQueue(str(tmp_path), 2, 10, 3600) for _ in range(2)]
+    # 相当于 start() 创建的标记目录
+    for state in ("queued", "running"):
+        (tmp_path / f".{state}").mkdir()
+    for i, priority in enumerate(["bulk", "normal", "interactive"]):
+        input_path = tmp_path / f"in{i}.doc"
+        input_path.write_bytes(b"x")
+        queues[i % 2].submit(str(input_path), "digest", "doc", "docx", priority, None)
+
+    stats = queues[0].stats()
+    assert stats["depth"] == 3
+    assert stats["depthByPriority"] == {"interactive": 1, "normal": 1, "bulk": 1}
+    assert stats["estimatedWait"] == dict.fromkeys(mainweb.JOB_PRIORITIES)
+
+    queues[1].record_duration(10)
+    assert queues[0].estimated_wait("normal") == 20
+    assert queues[0].estimated_wait("interactive") == 10
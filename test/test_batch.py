@@ -0,0 +1,26 @@
+import json
+import zipfile
+
+import mainweb
+
+
+def test_batch_archive_unique_names(tmp_path):
+    """同名输入出现多次时，每个结果在 zip 与 manifest 中的名称都不相同"""
+    archive_path = tmp_path / "out.zip"
+    archive = mainweb.BatchArchive(str(archive_path))
+    manifest = []
+    for i in range(4):
+        output = tmp_path / f"{i}.docx"
+        output.write_bytes(b"%d" % i)
+        item = {"name": "dir/a.doc", "sourceType": "doc", "targetType": "docx", "status": "ok", "error": None}
+        archive.add(item, str(output))
+        manifest.append(item)
+    archive.close(manifest)
+
+    with zipfile.ZipFile(archive_path) as z:
+        names = z.namelist()
+        outputs = [item["output"] for item in json.loads(z.read("manifest.json"))]
+        assert [z.read(name) for name in outputs] == [b"0", b"1", b"2", b"3"]
+    assert len(names) == len(set(names)) == 5
+    assert len(set(outputs)) == 4
+    assert outputs[:2] == ["dir/a.docx", "dir/a_(a.doc).docx"]
@@ -0,0 +1,38 @@
+import base64
+import hashlib
+import json
+import os
+
+import pytest
+
+import docconv_common
+
+
+@pytest.mark.parametrize("escape_slashes", [False, True])
+def test_decode_json_file_field(tmp_path, escape_slashes):
+    """解码结果跨越多个读取块，/ 被转义为 \\/ 时也能正确还原"""
+    data = os.urandom(3 * docconv_common.SPOOL_CHUNK_SIZE // 2)
+    body = json.dumps({"sourceType": "doc", "fileBytes": base64.b64encode(data).decode(), "targetType": "docx"})
+    if escape_slashes:
+        body = body.replace("/", "\\/")
+    json_path, output_path = tmp_path / "body.json", tmp_path / "data"
+    json_path.write_text(body)
+
+    fields, digest = docconv_common.decode_json_file_field(str(json_path), "fileBytes", str(output_path))
+    assert fields == {"sourceType": "doc", "fileBytes": "", "targetType": "docx"}
+    assert output_path.read_bytes() == data
+    assert digest == hashlib.sha256(data).hexdigest()
+
+
+def test_decode_json_file_field_invalid_base64(tmp_path):
+    json_path = tmp_path / "body.json"
+    json_path.write_text(json.dumps({"fileBytes": "QUJDQ"}))
+    with pytest.raises(ValueError, match="Invalid base64"):
+        docconv_common.decode_json_file_field(str(json_path), "fileBytes", str(tmp_path / "data"))
+
+
+def test_quarantine_expiry(tmp_path):
+    quarantine = docconv_common.Quarantine(str(tmp_path / "q"), ttl=0)
+    quarantine.add("abc", "deadline")
+    assert quarantine.check("abc") is None
+    assert not os.path.exists(tmp_path / "q" / "abc")
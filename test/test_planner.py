@@ -0,0 +1,32 @@
+import pytest
+
+import mainweb
+
+
+@pytest.mark.parametrize("source, target, route", [
+    ("dps", "pdf", (("wps", "dps", "pptx"), ("libreoffice", "pptx", "pdf"))),
+    ("wps", "odt", (("wps", "wps", "docx"), ("libreoffice", "docx", "odt"))),
+    ("doc", "docx", (("libreoffice", "doc", "docx"),)),
+    ("wps", "pdf", (("wps", "wps", "pdf"),)),
+])
+def test_plan_route(source, target, route):
+    assert mainweb.plan_route(source, target) == route
+
+
+@pytest.mark.parametrize("source, target", [
+    # 演示文稿不能转换为文字文档
+    ("ppt", "docx"),
+    ("dps", "docx"),
+])
+def test_plan_route_unsupported(source, target):
+    assert mainweb.plan_route(source, target) is None
+    assert mainweb.check_conversion(source, target) is not None
+
+
+@pytest.mark.parametrize("source, target", [("dps", "pdf"), ("wps", "odt"), ("et", "ods")])
+def test_plan_route_hops_connect(source, target):
+    """每一跳的输入是上一跳的输出，首尾分别为源格式与目标格式"""
+    route = mainweb.plan_route(source, target)
+    assert route[0][1] == source and route[-1][2] == target
+    for (_, _, produced), (_, consumed, _) in zip(route, route[1:]):
+        assert produced == consumed
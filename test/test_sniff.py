@@ -0,0 +1,82 @@
+import os
+import zipfile
+
+import pytest
+
+import mainweb
+from conftest import TEST_DIR
+
+
+def sample(name):
+    return os.path.join(TEST_DIR, name)
+
+
+@pytest.mark.parametrize("name, streams", [
+    ("test1.wps", {"WordDocument", "WpsCustomData"}),
+    ("test.et", {"Workbook", "ETExtData"}),
+    ("2019.et", {"Workbook", "ETExtData"}),
+    ("sub/test.dps", {"PowerPoint Document"}),
+])
+def test_ole2_stream_names(name, streams):
+    with open(sample(name), "rb") as f:
+        names = mainweb.ole2_stream_names(f)
+    assert streams <= names
+    assert "Root Entry" in names
+
+
+@pytest.mark.parametrize("name, fmt", [
+    ("test1.wps", "wps"),
+    ("test.et", "et"),
+    ("2019.et", "et"),
+    # WPS 演示文稿与 ppt 的 OLE2 结构相同，按内容只能识别为 ppt
+    ("sub/test.dps", "ppt"),
+])
+def test_sniff_format(name, fmt):
+    assert mainweb.sniff_format(sample(name)) == fmt
+
+
+@pytest.mark.parametrize("name, claimed, resolved", [
+    ("test1.wps", "wps", "wps"),
+    ("test1.wps", "doc", "wps"),
+    ("test.et", "xls", "et"),
+    ("sub/test.dps", "dps", "dps"),
+    ("sub/test.dps", "ppt", "ppt"),
+])
+def test_resolve_source_type(name, claimed, resolved):
+    assert mainweb.resolve_source_type(sample(name), claimed) == resolved
+
+
+@pytest.fixture
+def renamed_docx(tmp_path):
+    """扩展名被改为 .doc 的 docx"""
+    path = tmp_path / "report.doc"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("[Content_Types].xml", "<Types/>")
+        archive.writestr("word/document.xml", "<document/>")
+    return str(path)
+
+
+def test_renamed_ooxml(renamed_docx):
+    assert mainweb.sniff_format(renamed_docx) == "docx"
+    assert mainweb.resolve_source_type(renamed_docx, "doc") == "docx"
+    assert mainweb.resolve_source_type(renamed_docx, "wps") == "docx"
+
+
+def test_truncated_ole2(tmp_path):
+    """只剩文件头的 OLE2 文件：目录扇区读不到，无法识别时沿用声明的格式"""
+    path = tmp_path / "truncated.wps"
+    with open(sample("test1.wps"), "rb") as f:
+        path.write_bytes(f.read(1024))
+    with open(path, "rb") as f, pytest.raises(ValueError):
+        mainweb.ole2_stream_names(f)
+    assert mainweb.sniff_format(str(path)) is None
+    assert mainweb.resolve_source_type(str(path), "wps") == "wps"
+
+
+def test_truncated_ooxml(renamed_docx, tmp_path):
+    path = tmp_path / "truncated.docx"
+    with open(renamed_docx, "rb") as f:
+        path.write_bytes(f.read(40))
+    with pytest.raises(mainweb.ConversionError) as e:
+        mainweb.resolve_source_type(str(path), "docx")
+    assert e.value.status_code == 422